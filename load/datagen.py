@@ -0,0 +1,315 @@
+#!/usr/bin/python
+
+import sys
+import time
+import random
+import getopt
+import datetime
+import multiprocessing
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Generates lineitem rows in the pipe-delimited layout of lineitem.COLUMNS,
+# with the value distributions of the TPC-H specification: 1.5M orders per
+# unit of scale factor with 1 to 7 lines each (about 6M rows), parts and
+# suppliers scaled the same way, prices derived from the part, and ship,
+# commit and receipt dates that follow the order date, with the return flag
+# and line status set relative to the "current" date 1995-06-17.
+#
+# Orders are generated in blocks of BLOCK_ORDERS, each from its own seed, so
+# the output for a seed does not depend on how many workers or shards produce
+# it. With numpy installed, blocks are generated column-wise; the pure Python
+# fallback produces different (equally distributed) values for the same seed.
+ORDERS_PER_SF = 1500000
+PARTS_PER_SF = 200000
+SUPPLIERS_PER_SF = 10000
+BLOCK_ORDERS = 10000
+START_DATE = datetime.date(1992, 1, 1)
+END_DATE = datetime.date(1998, 12, 31)
+CURRENT_DAY = (datetime.date(1995, 6, 17) - START_DATE).days
+ORDER_DAYS = (END_DATE - START_DATE).days - 151
+DATES = [str(START_DATE + datetime.timedelta(days=i)) for i in range((END_DATE - START_DATE).days + 31)]
+SHIPINSTRUCT = ['DELIVER IN PERSON', 'COLLECT COD', 'NONE', 'TAKE BACK RETURN']
+SHIPMODE = ['REG AIR', 'AIR', 'RAIL', 'SHIP', 'TRUCK', 'MAIL', 'FOB']
+WORDS = ('furiously sly careful blithely quickly fluffily slyly ironic final regular express special pending even '
+         'bold silent unusual quiet ruthless daring busy close idle dogged stealthy thin accounts deposits packages '
+         'requests instructions theodolites pinto beans foxes ideas dependencies excuses platelets asymptotes '
+         'courts dolphins multipliers sauternes warthogs frets dinos attainments somas braids hockey players '
+         'sleep wake are cajole haggle nag use boost affix detect integrate maintain nod was lose sublate solve '
+         'thrash promise engage hinder print x-ray breach eat grow impress mold poach serve run dazzle snooze doze '
+         'unwind kindle play hang believe about above according across after against along alongside among '
+         'around at atop before behind beneath beside besides between beyond by despite during except for from '
+         'inside instead of into near of on outside over past since through throughout to toward under until up '
+         'upon without with within').split()
+COMMENT_POOL = 10000
+ROW_FORMAT = '%d|%d|%d|%d|%d|%.2f|%.2f|%.2f|%s|%s|%s|%s|%s|%s|%s|%s|\n'
+# Columns that queries are drawn from, and how often, as in
+# perf/sample/queries.
+QUERY_FIELDS = [(0, 87), (3, 7), (4, 50), (6, 11), (7, 9), (8, 3), (9, 2), (10, 156), (11, 136), (12, 155),
+                (13, 4), (14, 7), (15, 1)]
+
+
+def make_comments(count, rng):
+  # Comments of 10 to 43 characters made of the words of the TPC-H text
+  # grammar. Rows draw from a fixed pool of them.
+  comments = []
+  for _ in range(0, count):
+    length = rng.randint(10, 43)
+    words = []
+    size = -1
+    while size < length:
+      words.append(rng.choice(WORDS))
+      size += len(words[-1]) + 1
+    comments.append(' '.join(words)[:length].strip())
+  return comments
+
+
+comments = make_comments(COMMENT_POOL, random.Random(0))
+
+
+def orderkey(order):
+  # Order keys are sparse: only the first 8 of every 32 are used.
+  return order // 8 * 32 + order % 8 + 1
+
+
+def block_rows_numpy(first, count, seed, parts, suppliers):
+  rng = numpy.random.RandomState([seed, first // BLOCK_ORDERS])
+  orders = numpy.arange(first, first + count, dtype=numpy.int64)
+  lines = rng.randint(1, 8, count)
+  n = int(lines.sum())
+  orderkeys = numpy.repeat(orderkey(orders), lines)
+  orderdays = numpy.repeat(rng.randint(0, ORDER_DAYS, count), lines)
+  linenumbers = numpy.arange(n) - numpy.repeat(numpy.cumsum(lines) - lines, lines) + 1
+  partkeys = rng.randint(1, parts + 1, n).astype(numpy.int64)
+  suppkeys = (partkeys + rng.randint(0, 4, n) * (suppliers // 4 + (partkeys - 1) // suppliers)) % suppliers + 1
+  quantities = rng.randint(1, 51, n)
+  prices = quantities * (90000 + (partkeys // 10) % 20001 + 100 * (partkeys % 1000)) / 100.0
+  discounts = rng.randint(0, 11, n) / 100.0
+  taxes = rng.randint(0, 9, n) / 100.0
+  shipdays = orderdays + rng.randint(1, 122, n)
+  commitdays = orderdays + rng.randint(30, 91, n)
+  receiptdays = shipdays + rng.randint(1, 31, n)
+  returnflags = numpy.where(receiptdays <= CURRENT_DAY, rng.randint(0, 2, n), 2)
+  linestatuses = (shipdays <= CURRENT_DAY).astype(numpy.int64)
+  dates = numpy.array(DATES, dtype=object)
+  columns = [orderkeys, partkeys, suppkeys, linenumbers, quantities, prices, discounts, taxes,
+             numpy.array(['R', 'A', 'N'], dtype=object)[returnflags],
+             numpy.array(['O', 'F'], dtype=object)[linestatuses],
+             dates[shipdays], dates[commitdays], dates[receiptdays],
+             numpy.array(SHIPINSTRUCT, dtype=object)[rng.randint(0, len(SHIPINSTRUCT), n)],
+             numpy.array(SHIPMODE, dtype=object)[rng.randint(0, len(SHIPMODE), n)],
+             numpy.array(comments, dtype=object)[rng.randint(0, len(comments), n)]]
+  return zip(*[column.tolist() for column in columns])
+
+
+def block_rows_python(first, count, seed, parts, suppliers):
+  # random() scaled by hand is several times faster than randint().
+  rng = random.Random(seed * (1 << 32) + first // BLOCK_ORDERS)
+  r = rng.random
+  spread = suppliers // 4
+  rows = []
+  for order in range(first, first + count):
+    key = orderkey(order)
+    orderday = int(r() * ORDER_DAYS)
+    for linenumber in range(1, int(r() * 7) + 2):
+      partkey = int(r() * parts) + 1
+      suppkey = (partkey + int(r() * 4) * (spread + (partkey - 1) // suppliers)) % suppliers + 1
+      quantity = int(r() * 50) + 1
+      price = quantity * (90000 + (partkey // 10) % 20001 + 100 * (partkey % 1000)) / 100.0
+      shipday = orderday + int(r() * 121) + 1
+      receiptday = shipday + int(r() * 30) + 1
+      rows.append((key, partkey, suppkey, linenumber, quantity, price, int(r() * 11) / 100.0, int(r() * 9) / 100.0,
+                   ('R' if r() < 0.5 else 'A') if receiptday <= CURRENT_DAY else 'N',
+                   'F' if shipday <= CURRENT_DAY else 'O', DATES[shipday], DATES[orderday + int(r() * 61) + 30],
+                   DATES[receiptday], SHIPINSTRUCT[int(r() * 4)], SHIPMODE[int(r() * 7)],
+                   comments[int(r() * COMMENT_POOL)]))
+  return rows
+
+
+def block_rows(first, count, seed, parts, suppliers):
+  if numpy is not None:
+    return block_rows_numpy(first, count, seed, parts, suppliers)
+  return block_rows_python(first, count, seed, parts, suppliers)
+
+
+def block_text(args):
+  first, count, seed, parts, suppliers = args
+  return ''.join([ROW_FORMAT % row for row in block_rows(first, count, seed, parts, suppliers)])
+
+
+class Generator(object):
+  def __init__(self, scale, seed=0):
+    if scale <= 0:
+      raise ValueError('Scale factor must be positive')
+    self.seed = seed
+    self.orders = max(1, int(ORDERS_PER_SF * scale))
+    self.parts = max(1, int(PARTS_PER_SF * scale))
+    self.suppliers = max(4, int(SUPPLIERS_PER_SF * scale))
+
+  def blocks(self, start, end):
+    # Arguments for block_text() for the orders in [start, end).
+    for first in range(start, end, BLOCK_ORDERS):
+      yield first, min(BLOCK_ORDERS, end - first), self.seed, self.parts, self.suppliers
+
+  def shard_range(self, shard, shards):
+    # Shards split the blocks, not the orders, so that they concatenate to
+    # the same rows as a single output.
+    block_count = (self.orders + BLOCK_ORDERS - 1) // BLOCK_ORDERS
+    start = block_count * shard // shards * BLOCK_ORDERS
+    end = min(block_count * (shard + 1) // shards * BLOCK_ORDERS, self.orders)
+    return start, end
+
+
+def write_shard(args):
+  scale, seed, shard, shards, path = args
+  generator = Generator(scale, seed)
+  start, end = generator.shard_range(shard, shards)
+  rows = 0
+  with open(path, 'wb') as out:
+    for block in generator.blocks(start, end):
+      text = block_text(block)
+      rows += text.count('\n')
+      out.write(text)
+  return rows
+
+
+def write_stream(generator, out, num_workers):
+  # Blocks are generated in parallel but written in order.
+  rows = 0
+  pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+  try:
+    blocks = generator.blocks(0, generator.orders)
+    texts = pool.imap(block_text, blocks) if pool is not None else (block_text(block) for block in blocks)
+    for text in texts:
+      rows += text.count('\n')
+      out.write(text)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  return rows
+
+
+def write_appends(generator, path, count):
+  # New rows for the append benchmarks: orders after the last one loaded,
+  # starting at a fresh block so that they do not repeat its values.
+  written = 0
+  start = (generator.orders + BLOCK_ORDERS - 1) // BLOCK_ORDERS * BLOCK_ORDERS
+  with open(path, 'wb') as out:
+    # Every order has at least one line, so count orders are enough.
+    for block in generator.blocks(start, start + count):
+      for row in block_rows(*block):
+        if written == count:
+          return written
+        out.write(ROW_FORMAT % row)
+        written += 1
+  return written
+
+
+def write_queries(generator, path, count):
+  # Match queries in the "<field-id>|<value>" format of perf/sample/queries,
+  # on values of rows spread over the whole generated range.
+  rng = random.Random(generator.seed)
+  total = sum(weight for _, weight in QUERY_FIELDS)
+  block_count = (generator.orders + BLOCK_ORDERS - 1) // BLOCK_ORDERS
+  rows = []
+  for block in sorted(rng.sample(range(0, block_count), min(block_count, 10))):
+    first = block * BLOCK_ORDERS
+    rows.extend(block_rows(first, min(BLOCK_ORDERS, generator.orders - first), generator.seed, generator.parts,
+                           generator.suppliers))
+  with open(path, 'w') as out:
+    for _ in range(0, count):
+      fields = (ROW_FORMAT % rng.choice(rows)).split('|')
+      pick = rng.random() * total
+      for field, weight in QUERY_FIELDS:
+        pick -= weight
+        if pick < 0:
+          break
+      out.write('%d|%s\n' % (field, fields[field]))
+  return count
+
+
+def main(argv):
+  scale = 1.0
+  seed = 0
+  output = '-'
+  shards = 1
+  num_workers = multiprocessing.cpu_count()
+  append_file = ''
+  append_rows = 100000
+  query_file = ''
+  query_count = 1000
+  help_msg = ('datagen.py -f <scale-factor> -s <seed> -o <output-file|-> -n <shards> -w <workers> '
+              '-a <append-file> -A <append-rows> -q <query-file> -Q <query-count>')
+  try:
+    opts, args = getopt.getopt(argv, 'hf:s:o:n:w:a:A:q:Q:', ['scale=', 'seed=', 'output=', 'shards=', 'workers=',
+                                                            'appends=', 'append-rows=', 'queries=',
+                                                            'query-count='])
+  except getopt.GetoptError:
+    print >> sys.stderr, help_msg
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt == '-h':
+      print help_msg
+      sys.exit()
+    elif opt in ('-f', '--scale'):
+      scale = float(arg)
+    elif opt in ('-s', '--seed'):
+      seed = int(arg)
+    elif opt in ('-o', '--output'):
+      output = arg
+    elif opt in ('-n', '--shards'):
+      shards = int(arg)
+    elif opt in ('-w', '--workers'):
+      num_workers = int(arg)
+    elif opt in ('-a', '--appends'):
+      append_file = arg
+    elif opt in ('-A', '--append-rows'):
+      append_rows = int(arg)
+    elif opt in ('-q', '--queries'):
+      query_file = arg
+    elif opt in ('-Q', '--query-count'):
+      query_count = int(arg)
+  if shards < 1 or num_workers < 1:
+    print >> sys.stderr, 'Error: Shards and workers must be positive!'
+    sys.exit(2)
+  if output == '-' and shards > 1:
+    print >> sys.stderr, 'Error: Cannot write shards to standard output!'
+    sys.exit(2)
+
+  try:
+    generator = Generator(scale, seed)
+  except ValueError as e:
+    print >> sys.stderr, 'Error: %s' % e
+    sys.exit(2)
+
+  # Progress goes to stderr, as the rows may be going to stdout.
+  start = time.time()
+  if output == '-':
+    rows = write_stream(generator, sys.stdout, num_workers)
+    sys.stdout.flush()
+  elif shards == 1:
+    with open(output, 'wb') as out:
+      rows = write_stream(generator, out, num_workers)
+  else:
+    pool = multiprocessing.Pool(min(num_workers, shards))
+    try:
+      rows = sum(pool.map(write_shard, [(scale, seed, i, shards, '%s.%d' % (output, i)) for i in range(0, shards)]))
+    finally:
+      pool.close()
+      pool.join()
+  elapsed = time.time() - start
+  print >> sys.stderr, 'Generated %d rows (%d orders) in %.1fs, %.0f rows/s' % (rows, generator.orders, elapsed,
+                                                                                rows / elapsed if elapsed else 0.0)
+  if append_file != '':
+    print >> sys.stderr, 'Wrote %d append rows to %s' % (write_appends(generator, append_file, append_rows),
+                                                         append_file)
+  if query_file != '':
+    print >> sys.stderr, 'Wrote %d queries to %s' % (write_queries(generator, query_file, query_count), query_file)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
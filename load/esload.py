@@ -1,46 +1,635 @@
 #!/usr/bin/python
 
+import os
 import sys
+import re
+import json
+import mmap
+import time
+import hashlib
+import random
 import getopt
-from elasticsearch import Elasticsearch, helpers
+import threading
+import multiprocessing
+import Queue
+from elasticsearch import Elasticsearch, TransportError, helpers
 import socket
+import lineitem
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'perf'))
+import results
 
 es = Elasticsearch(socket.gethostname())
-batch_size = 100
+batch_bytes = 5 * 1024 * 1024
+min_batch_bytes = 64 * 1024
+max_batch_bytes = 64 * 1024 * 1024
+batch_latency = 1.0
+max_retries = 10
+backoff_base = 0.1
+backoff_max = 30.0
+typed = False
+num_senders = 0
+queue_depth = 4
+checkpoint_file = ''
+checkpoint_interval = 10.0
+resume = False
+dead_letter = None
+merge_timeout = 6 * 60 * 60
+progress_interval = 100000
+no_errors = re.compile(r'"errors"\s*:\s*false')
+progress = None
+
+
+class Progress(object):
+  def __init__(self):
+    self.lock = multiprocessing.Lock()
+    self.loaded = multiprocessing.Value('l', 0, lock=False)
+    self.successful = multiprocessing.Value('l', 0, lock=False)
+
+  def update(self, loaded, successful):
+    with self.lock:
+      before = self.loaded.value
+      self.loaded.value += loaded
+      self.successful.value += successful
+      if self.loaded.value / progress_interval > before / progress_interval:
+        print 'success: %d failed: %d' % (self.successful.value, self.loaded.value - self.successful.value)
+        sys.stdout.flush()
+
+
+class BatchSizer(object):
+  # Grows the bulk payload while requests complete well within the target
+  # latency, and shrinks it multiplicatively on slow responses or rejections.
+  def __init__(self, target_bytes, target_latency):
+    self.target_bytes = target_bytes
+    self.target_latency = target_latency
+
+  def observe(self, elapsed, rejected):
+    if rejected:
+      self.target_bytes /= 2
+    elif elapsed > self.target_latency:
+      self.target_bytes = self.target_bytes * 3 / 4
+    elif elapsed < self.target_latency / 2:
+      self.target_bytes = self.target_bytes * 5 / 4
+    self.target_bytes = min(max(self.target_bytes, min_batch_bytes), max_batch_bytes)
+
+
+class StageTimer(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.totals = {}
+
+  def add(self, stage, elapsed):
+    with self.lock:
+      self.totals[stage] = self.totals.get(stage, 0.0) + elapsed
+
+  def get(self, stage):
+    return self.totals.get(stage, 0.0)
+
+
+class SenderFailure(object):
+  # The first exception raised in a sender thread. Once one is recorded the
+  # other senders stop sending, and it is re-raised in the main thread after
+  # they have all stopped, so the load fails and can be resumed.
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.exc_info = None
+
+  def record(self):
+    with self.lock:
+      if self.exc_info is None:
+        self.exc_info = sys.exc_info()
+
+  def failed(self):
+    return self.exc_info is not None
+
+  def reraise(self):
+    if self.exc_info is not None:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+class Checkpoint(object):
+  # Tracks the byte offset up to which every batch of a range has been
+  # acknowledged. With several senders batches can complete out of order, so
+  # completions past the first outstanding batch are held back until the gap
+  # is filled.
+  def __init__(self, path, state):
+    self.path = path
+    self.state = state
+    self.lock = threading.Lock()
+    self.completed = {}
+    self.next_seq = 0
+    self.last_save = time.time()
+
+  def complete(self, seq, offset, next_id, loaded, successful):
+    with self.lock:
+      self.completed[seq] = (offset, next_id, loaded, successful)
+      while self.next_seq in self.completed:
+        offset, next_id, loaded, successful = self.completed.pop(self.next_seq)
+        self.state['offset'] = offset
+        self.state['next_id'] = next_id
+        self.state['loaded'] += loaded
+        self.state['successful'] += successful
+        self.next_seq += 1
+      if time.time() - self.last_save >= checkpoint_interval:
+        self.save()
+
+  def save(self):
+    if self.path == '':
+      return
+    tmp_path = '%s.tmp' % self.path
+    with open(tmp_path, 'w') as out:
+      json.dump(self.state, out)
+    os.rename(tmp_path, self.path)
+    self.last_save = time.time()
+
+
+class DeadLetter(object):
+  # Rejected documents are appended as one JSON record per line, holding the
+  # bulk action and source as sent plus the error, so they can be replayed.
+  # Each record is a single O_APPEND write, which keeps records from
+  # concurrent workers intact.
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+    self.lock = threading.Lock()
+
+  def write(self, action, source, status, error):
+    record = '{"status": %s, "error": %s, "action": %s, "source": %s}\n' % (json.dumps(status), json.dumps(error),
+                                                                           action, source)
+    with self.lock:
+      if self.fd is None:
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+      os.write(self.fd, record)
 
 
 def csv2json(index, doc_type, id, csv):
-  json = {'_index' : index, '_type': doc_type, '_id': id}
   fields = csv.split('|')
-  for i in range(0, len(fields)):
-    json['field%d' % i] = fields[i]
+  if typed:
+    json = lineitem.typed_fields(fields)
+  else:
+    json = {}
+    for i in range(0, len(fields)):
+      json['field%d' % i] = fields[i]
+  json.update({'_index' : index, '_type': doc_type, '_id': id})
   return json
 
 
-def load_data(input_file, index, doc_type, seed):
+def render(doc):
+  # Serializes a document into its bulk action and source lines once, so the
+  # batch size in bytes is known before the request is built.
+  action = {'index': {'_index': doc.pop('_index'), '_type': doc.pop('_type'), '_id': doc.pop('_id')}}
+  return json.dumps(action), json.dumps(doc)
+
+
+def expand_rendered(doc):
+  return doc
+
+
+def is_rejection(item):
+  status = item.get('status')
+  error = str(item.get('error', '')).lower().replace('_', '')
+  return status == 429 or 'rejectedexecution' in error
+
+
+def backoff(attempt):
+  # Full jitter keeps concurrent workers from retrying in lock-step.
+  return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+
+def send_batch(docs, sizer):
+  # Rejected documents are retried with backoff; documents that fail for any
+  # other reason, or are still rejected after max_retries, go to the dead
+  # letter file. Connection errors propagate so the load can be resumed.
+  successful = 0
+  pending = docs
+  for attempt in range(0, max_retries + 1):
+    rejected = []
+    start = time.time()
+    try:
+      results = list(helpers.streaming_bulk(es, pending, chunk_size=len(pending), max_chunk_bytes=sys.maxint,
+                                            raise_on_error=False, expand_action_callback=expand_rendered))
+    except TransportError as e:
+      if e.status_code != 429:
+        raise
+      results = [(False, {'index': {'status': 429, 'error': str(e)}})] * len(pending)
+    for doc, (ok, result) in zip(pending, results):
+      item = result.values()[0]
+      if ok:
+        successful += 1
+      elif is_rejection(item) and attempt < max_retries:
+        rejected.append(doc)
+      else:
+        dead_letter.write(doc[0], doc[1], item.get('status'), item.get('error'))
+    sizer.observe(time.time() - start, len(rejected) > 0)
+    if not rejected:
+      break
+    pending = rejected
+    time.sleep(backoff(attempt))
+  return successful
+
+
+def split_file(input_file, num_chunks):
+  # Chunk boundaries are moved forward to the start of the next line, so that
+  # every chunk holds whole lines only.
+  size = os.path.getsize(input_file)
+  offsets = [0]
+  with open(input_file, 'rb') as ifp:
+    for i in range(1, num_chunks):
+      ifp.seek(max(size * i / num_chunks, offsets[-1]))
+      ifp.readline()
+      offsets.append(min(ifp.tell(), size))
+  offsets.append(size)
+  return [(offsets[i], offsets[i + 1]) for i in range(0, num_chunks) if offsets[i] < offsets[i + 1]]
+
+
+def count_lines(chunk):
+  input_file, start, end = chunk
+  count = 0
+  last = '\n'
+  with open(input_file, 'rb') as ifp:
+    ifp.seek(start)
+    remaining = end - start
+    while remaining > 0:
+      block = ifp.read(min(remaining, 1 << 20))
+      if not block:
+        break
+      count += block.count('\n')
+      last = block[-1]
+      remaining -= len(block)
+  if last != '\n':
+    count += 1
+  return count
+
+
+def read_lines(input_file, start, end):
+  if input_file == '-':
+    # Standard input, e.g. rows piped from datagen.py, is read through once.
+    offset = start
+    for line in sys.stdin:
+      offset += len(line)
+      yield offset, line
+    return
+  with open(input_file, 'rb') as ifp:
+    ifp.seek(start)
+    offset = start
+    while offset < end:
+      line = ifp.readline()
+      if not line:
+        break
+      offset += len(line)
+      yield offset, line
+
+
+def parse_batches(input_file, start, end, index, doc_type, seed, sizer):
+  # Yields batches of rendered documents along with the byte offset and
+  # document id at which the next batch starts.
   doc_no = seed
+  docs = []
+  docs_bytes = 0
+  offset = start
+  for offset, line in read_lines(input_file, start, end):
+    doc_id = str(doc_no)
+    doc = render(csv2json(index, doc_type, doc_id, line.rstrip()))
+    docs.append(doc)
+    docs_bytes += len(doc[0]) + len(doc[1]) + 2
+    doc_no += 1
+    if docs_bytes >= sizer.target_bytes:
+      yield docs, offset, doc_no
+      docs = []
+      docs_bytes = 0
+
+  if len(docs) > 0:
+    yield docs, offset, doc_no
+
+
+def open_checkpoint(path, start, end, seed):
+  state = {'seed': seed, 'start': start, 'end': end, 'offset': start, 'next_id': seed, 'loaded': 0, 'successful': 0}
+  if path != '' and resume and os.path.exists(path):
+    with open(path) as ifp:
+      saved = json.load(ifp)
+    if saved['start'] != start or saved['end'] != end:
+      raise ValueError('Checkpoint %s covers bytes %d-%d, expected %d-%d' % (path, saved['start'], saved['end'],
+                                                                             start, end))
+    state = saved
+    print 'Resuming bytes %d-%d from offset %d, document %s' % (start, end, state['offset'], state['next_id'])
+  progress.update(state['loaded'], state['successful'])
+  checkpoint = Checkpoint(path, state)
+  checkpoint.save()
+  return checkpoint
+
+
+def load_range(input_file, start, end, index, doc_type, seed, checkpoint_path):
+  if num_senders > 0:
+    return load_range_pipelined(input_file, start, end, index, doc_type, seed, checkpoint_path)
+
+  sizer = BatchSizer(batch_bytes, batch_latency)
+  checkpoint = open_checkpoint(checkpoint_path, start, end, seed)
+  state = checkpoint.state
+  batches = parse_batches(input_file, state['offset'], end, index, doc_type, state['next_id'], sizer)
+  for seq, (docs, offset, next_id) in enumerate(batches):
+    added = send_batch(docs, sizer)
+    progress.update(len(docs), added)
+    checkpoint.complete(seq, offset, next_id, len(docs), added)
+  checkpoint.save()
+
+  print 'Batch size settled at %d bytes' % sizer.target_bytes
+  return state['loaded'], state['successful']
+
+
+def load_range_pipelined(input_file, start, end, index, doc_type, seed, checkpoint_path):
+  # The parser fills a bounded queue of batches while sender threads drain it,
+  # so parsing overlaps with bulk requests and at most queue_depth batches are
+  # held in memory at any time.
+  sizer = BatchSizer(batch_bytes, batch_latency)
+  timer = StageTimer()
+  checkpoint = open_checkpoint(checkpoint_path, start, end, seed)
+  state = checkpoint.state
+  batches = Queue.Queue(queue_depth)
+  failure = SenderFailure()
+
+  def sender():
+    while True:
+      wait_start = time.time()
+      batch = batches.get()
+      send_start = time.time()
+      timer.add('queue wait', send_start - wait_start)
+      if batch is None:
+        break
+      if failure.failed():
+        # Drain the queue so the parser never blocks on a full one.
+        continue
+      seq, docs, offset, next_id = batch
+      try:
+        added = send_batch(docs, sizer)
+      except Exception:
+        failure.record()
+        continue
+      timer.add('send', time.time() - send_start)
+      progress.update(len(docs), added)
+      checkpoint.complete(seq, offset, next_id, len(docs), added)
+
+  senders = [threading.Thread(target=sender) for _ in range(0, num_senders)]
+  for thread in senders:
+    thread.start()
+
+  seq = 0
+  parse_start = time.time()
+  for docs, offset, next_id in parse_batches(input_file, state['offset'], end, index, doc_type, state['next_id'],
+                                             sizer):
+    if failure.failed():
+      break
+    put_start = time.time()
+    timer.add('parse', put_start - parse_start)
+    batches.put((seq, docs, offset, next_id))
+    seq += 1
+    parse_start = time.time()
+    timer.add('queue full', parse_start - put_start)
+  timer.add('parse', time.time() - parse_start)
+
+  for _ in senders:
+    batches.put(None)
+  for thread in senders:
+    thread.join()
+  checkpoint.save()
+  failure.reraise()
+
+  print 'Batch size settled at %d bytes' % sizer.target_bytes
+  print 'Parser: parse %.2fs, blocked on full queue %.2fs' % (timer.get('parse'), timer.get('queue full'))
+  print 'Senders (%d, summed): send %.2fs, waiting on empty queue %.2fs' % (num_senders, timer.get('send'),
+                                                                         timer.get('queue wait'))
+  return state['loaded'], state['successful']
+
+
+def init_worker(shared_progress):
+  # Connections must not be shared with the parent process, so every worker
+  # opens its own client.
+  global es, progress
+  es = Elasticsearch(socket.gethostname(), maxsize=max(num_senders, 1))
+  progress = shared_progress
+
+
+def load_chunk(args):
+  return load_range(*args)
+
+
+def cache_path(cache_dir, input_file, index, doc_type, seed):
+  # Keyed on the input file's path, size and modification time, so that
+  # finding an existing cache does not mean reading the whole input.
+  stat = os.stat(input_file)
+  digest = hashlib.sha1('%s|%d|%d' % (os.path.abspath(input_file), stat.st_size, int(stat.st_mtime * 1000)))
+  encoding = 'typed' if typed else 'string'
+  return os.path.join(cache_dir, '%s-%s-%s-%d-%s.ndjson' % (digest.hexdigest(), index, doc_type, seed, encoding))
+
+
+def build_cache(input_file, index, doc_type, seed, path):
+  print 'Building bulk cache %s...' % path
+  cache_dir = os.path.dirname(path)
+  if cache_dir and not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  sizer = BatchSizer(1 << 20, batch_latency)
+  tmp_path = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp_path, 'wb') as out:
+    for docs, _, _ in parse_batches(input_file, 0, os.path.getsize(input_file), index, doc_type, seed, sizer):
+      for action, source in docs:
+        out.write('%s\n%s\n' % (action, source))
+  os.rename(tmp_path, path)
+
+
+def send_raw_batch(body, sizer):
+  # Sends pre-rendered bulk lines as-is. The response is only decoded when the
+  # cluster reports errors, and only item statuses and errors are requested.
+  successful = 0
+  connection = es.transport.get_connection()
+  for attempt in range(0, max_retries + 1):
+    start = time.time()
+    status, headers, data = connection.perform_request('POST', '/_bulk',
+                                                       params={'filter_path': 'errors,items.*.status,items.*.error'},
+                                                       body=body, ignore=(429,))
+    pending = body.count('\n') / 2
+    if status == 429:
+      items = [{'status': 429, 'error': data}] * pending
+    elif no_errors.search(data):
+      items = []
+      successful += pending
+    else:
+      items = [item.values()[0] for item in json.loads(data)['items']]
+
+    lines = None
+    rejected = []
+    for i, item in enumerate(items):
+      if 200 <= item['status'] < 300:
+        successful += 1
+      elif is_rejection(item) and attempt < max_retries:
+        rejected.append(i)
+      else:
+        lines = lines or body.split('\n')
+        dead_letter.write(lines[2 * i], lines[2 * i + 1], item['status'], item.get('error'))
+    sizer.observe(time.time() - start, len(rejected) > 0)
+    if not rejected:
+      break
+    lines = lines or body.split('\n')
+    body = ''.join('%s\n%s\n' % (lines[2 * i], lines[2 * i + 1]) for i in rejected)
+    time.sleep(backoff(attempt))
+  return successful
+
+
+def load_cached(path, seed):
+  global progress
+  progress = Progress()
+  sizer = BatchSizer(batch_bytes, batch_latency)
+  cursor_lock = threading.Lock()
+
+  with open(path, 'rb') as ifp:
+    mm = mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+  checkpoint = open_checkpoint(checkpoint_file, 0, len(mm), seed)
+  state = checkpoint.state
+  cursor = [state['offset'], 0]
+  failure = SenderFailure()
+
+  def next_chunk():
+    # Chunks end right before an action line, so each one holds whole
+    # action/source pairs.
+    with cursor_lock:
+      start, seq = cursor
+      if start >= len(mm):
+        return None
+      end = mm.find('\n{"index"', start + sizer.target_bytes)
+      end = len(mm) if end == -1 else end + 1
+      cursor[0] = end
+      cursor[1] += 1
+    return seq, end, mm[start:end]
+
+  def sender():
+    chunk = next_chunk()
+    while chunk is not None and not failure.failed():
+      seq, end, body = chunk
+      loaded = body.count('\n') / 2
+      try:
+        added = send_raw_batch(body, sizer)
+      except Exception:
+        failure.record()
+        break
+      progress.update(loaded, added)
+      checkpoint.complete(seq, end, None, loaded, added)
+      chunk = next_chunk()
+
+  senders = [threading.Thread(target=sender) for _ in range(0, max(num_senders, 1))]
+  for thread in senders:
+    thread.start()
+  for thread in senders:
+    thread.join()
+  checkpoint.save()
+  mm.close()
+  failure.reraise()
+
+  print 'Batch size settled at %d bytes' % sizer.target_bytes
+  print 'Finished! Inserted: %d Failed: %d' % (state['successful'], state['loaded'] - state['successful'])
+  return state['loaded'], state['successful']
+
+
+def load_data(input_file, index, doc_type, seed):
+  global progress
+  progress = Progress()
+  end = os.path.getsize(input_file) if input_file != '-' else sys.maxint
+  loaded, successful = load_range(input_file, 0, end, index, doc_type, seed, checkpoint_file)
+  print 'Finished! Inserted: %d Failed: %d' % (successful, loaded - successful)
+  return loaded, successful
+
+
+def load_data_parallel(input_file, index, doc_type, seed, num_workers):
+  shared_progress = Progress()
+  pool = multiprocessing.Pool(num_workers, init_worker, (shared_progress,))
+  try:
+    chunks = split_file(input_file, num_workers)
+    line_counts = pool.map(count_lines, [(input_file, start, end) for start, end in chunks])
+
+    # Each chunk gets the id range its lines would have had in a sequential
+    # load, so the resulting index is identical regardless of worker count.
+    # Chunks are checkpointed separately, next to a file recording the seed.
+    tasks = []
+    chunk_seed = seed
+    for i, ((start, end), line_count) in enumerate(zip(chunks, line_counts)):
+      chunk_checkpoint = '%s.%d' % (checkpoint_file, i) if checkpoint_file != '' else ''
+      tasks.append((input_file, start, end, index, doc_type, chunk_seed, chunk_checkpoint))
+      chunk_seed += line_count
+    if checkpoint_file != '':
+      Checkpoint(checkpoint_file, {'seed': seed, 'chunks': len(tasks)}).save()
+    print 'Loading %d chunks with %d workers...' % (len(tasks), num_workers)
+
+    results = pool.map(load_chunk, tasks)
+  finally:
+    pool.close()
+    pool.join()
+
+  loaded = sum(result[0] for result in results)
+  successful = sum(result[1] for result in results)
+  print 'Finished! Inserted: %d Failed: %d' % (successful, loaded - successful)
+  return loaded, successful
+
+
+def index_stats(index):
+  stats = es.indices.stats(index=index, metric='segments,store')['_all']['total']
+  return stats['segments']['count'], stats['store']['size_in_bytes']
+
+
+def tune_index(index):
+  # Refreshes and replicas only cost indexing throughput during a bulk load,
+  # so both are disabled until the load is done.
+  settings = es.indices.get_settings(index=index).values()[0]['settings']['index']
+  original = {
+    'refresh_interval': settings.get('refresh_interval', '1s'),
+    'number_of_replicas': settings['number_of_replicas'],
+  }
+  print 'Disabling refresh and replicas (were %s, %s)...' % (original['refresh_interval'],
+                                                             original['number_of_replicas'])
+  es.indices.put_settings(index=index, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+  return original
+
+
+def restore_index(index, original, max_segments):
+  # Merging before replicas come back means the replicas are built from the
+  # merged segments instead of merging on every copy.
+  es.indices.put_settings(index=index, body={'index': {'refresh_interval': original['refresh_interval']}})
+  es.indices.refresh(index=index)
+  after_load = index_stats(index)
+  after_merge = None
+  if max_segments > 0:
+    print 'Force-merging to %d segments...' % max_segments
+    es.indices.forcemerge(index=index, max_num_segments=max_segments, request_timeout=merge_timeout)
+    after_merge = index_stats(index)
+  print 'Restoring replicas to %s...' % original['number_of_replicas']
+  es.indices.put_settings(index=index, body={'index': {'number_of_replicas': original['number_of_replicas']}})
+  return after_load, after_merge
+
+
+def replay_dead_letter(path):
+  global progress
+  progress = Progress()
+  sizer = BatchSizer(batch_bytes, batch_latency)
+  loaded = 0
   successful = 0
   docs = []
-  with open(input_file) as ifp:
+  docs_bytes = 0
+  with open(path) as ifp:
     for line in ifp:
-      doc_id = str(doc_no)
-      doc = csv2json(index, doc_type, doc_id, line.rstrip())
+      record = json.loads(line)
+      doc = (json.dumps(record['action']), json.dumps(record['source']))
       docs.append(doc)
-      doc_no += 1
-      if len(docs) == batch_size:
-        docs_iter = iter(docs)
-        (added, tmp) = helpers.bulk(es, docs_iter)
+      docs_bytes += len(doc[0]) + len(doc[1]) + 2
+      if docs_bytes >= sizer.target_bytes:
+        added = send_batch(docs, sizer)
+        loaded += len(docs)
         successful += added
+        progress.update(len(docs), added)
         docs = []
-      if doc_no % 100000 == 0:
-        print 'success: %d failed: %s' % (successful, doc_no - successful - seed)
+        docs_bytes = 0
 
   if len(docs) > 0:
-    docs_iter = iter(docs)
-    (added, tmp) = helpers.bulk(es, docs_iter)
+    added = send_batch(docs, sizer)
+    loaded += len(docs)
     successful += added
 
-  print 'Finished! Inserted: %d Failed: %d' % (successful, doc_no - successful - seed)
+  print 'Finished! Replayed: %d Failed: %d' % (successful, loaded - successful)
 
 
 def main(argv):
@@ -48,9 +637,23 @@ def main(argv):
   index = 'bench'
   doc_type = 'data'
   seed = -1
-  help_message = 'esload.py -d <data-file> -i <index> -t <type> -s <seed>'
+  num_workers = 1
+  cache_dir = ''
+  dead_letter_file = 'dead_letter.ndjson'
+  replay_file = ''
+  tune = False
+  max_segments = 0
+  results_dir = results.RESULTS_DIR
+  label = ''
+  global es, batch_bytes, batch_latency, num_senders, queue_depth, typed, checkpoint_file, resume, dead_letter
+  help_message = ('esload.py -d <data-file> -i <index> -t <type> -s <seed> -w <workers> -B <batch-bytes> '
+                  '-L <batch-latency> -p <senders> -q <queue-depth> -c <cache-dir> -y -k <checkpoint> -r '
+                  '-D <dead-letter-file> -R <replay-file> -T -m <max-segments> -O <results-dir> --label <label>')
   try:
-    opts, args = getopt.getopt(argv, 'hd:i:t:s:', ['data=', 'index=', 'type=', 'seed='])
+    opts, args = getopt.getopt(argv, 'hd:i:t:s:w:B:L:p:q:c:yk:rD:R:Tm:O:',
+                               ['data=', 'index=', 'type=', 'seed=', 'workers=', 'batch-bytes=', 'batch-latency=',
+                                'senders=', 'queue-depth=', 'cache-dir=', 'typed', 'checkpoint=', 'resume',
+                                'dead-letter=', 'replay=', 'tune', 'max-segments=', 'results-dir=', 'label='])
   except getopt.GetoptError:
     print help_message
     sys.exit(2)
@@ -66,16 +669,109 @@ def main(argv):
       doc_type = arg
     elif opt in ('-s', '--seed'):
       seed = int(arg)
-  if input_file == '':
+    elif opt in ('-w', '--workers'):
+      num_workers = int(arg)
+    elif opt in ('-B', '--batch-bytes'):
+      batch_bytes = int(arg)
+    elif opt in ('-L', '--batch-latency'):
+      batch_latency = float(arg)
+    elif opt in ('-p', '--senders'):
+      num_senders = int(arg)
+    elif opt in ('-q', '--queue-depth'):
+      queue_depth = int(arg)
+    elif opt in ('-c', '--cache-dir'):
+      cache_dir = arg
+    elif opt in ('-y', '--typed'):
+      typed = True
+    elif opt in ('-k', '--checkpoint'):
+      checkpoint_file = arg
+    elif opt in ('-r', '--resume'):
+      resume = True
+    elif opt in ('-D', '--dead-letter'):
+      dead_letter_file = arg
+    elif opt in ('-R', '--replay'):
+      replay_file = arg
+    elif opt in ('-T', '--tune'):
+      tune = True
+    elif opt in ('-m', '--max-segments'):
+      max_segments = int(arg)
+    elif opt in ('-O', '--results-dir'):
+      results_dir = arg
+    elif opt == '--label':
+      label = arg
+  if input_file == '' and replay_file == '':
     print 'Error: Must specify data-file!'
     sys.exit(2)
-    
-  if seed == -1:
+  if input_file == '-' and (num_workers > 1 or cache_dir != '' or checkpoint_file != ''):
+    print 'Error: Cannot split, cache or checkpoint standard input!'
+    sys.exit(2)
+  if cache_dir != '' and num_workers > 1:
+    print 'Error: A cached load runs in one process, use --senders instead of --workers!'
+    sys.exit(2)
+  if resume and checkpoint_file == '':
+    print 'Error: Must specify checkpoint file to resume from!'
+    sys.exit(2)
+  if replay_file != '' and os.path.abspath(replay_file) == os.path.abspath(dead_letter_file):
+    print 'Error: Dead letter file must differ from the file being replayed!'
+    sys.exit(2)
+
+  dead_letter = DeadLetter(dead_letter_file)
+
+  if num_senders > 1:
+    es = Elasticsearch(socket.gethostname(), maxsize=num_senders)
+
+  if replay_file != '':
+    replay_dead_letter(replay_file)
+    return
+
+  if resume and os.path.exists(checkpoint_file):
+    with open(checkpoint_file) as ifp:
+      seed = json.load(ifp)['seed']
+  elif seed == -1:
     seed = es.count(index=index)['count']
-  
+
   print seed
 
-  load_data(input_file, index, doc_type, seed)
+  if tune:
+    before = index_stats(index)
+    original = tune_index(index)
+
+  env = results.environment(es, index)
+  try:
+    if cache_dir != '':
+      path = cache_path(cache_dir, input_file, index, doc_type, seed)
+      if not os.path.exists(path):
+        build_cache(input_file, index, doc_type, seed, path)
+      start = time.time()
+      loaded, successful = load_cached(path, seed)
+    elif num_workers > 1:
+      start = time.time()
+      loaded, successful = load_data_parallel(input_file, index, doc_type, seed, num_workers)
+    else:
+      start = time.time()
+      loaded, successful = load_data(input_file, index, doc_type, seed)
+    elapsed = time.time() - start
+  finally:
+    if tune:
+      after_load, after_merge = restore_index(index, original, max_segments)
+
+  if tune:
+    merged = (', %d after force-merge' % after_merge[0]) if after_merge else ''
+    print 'Segments: %d before load, %d after load%s' % (before[0], after_load[0], merged)
+    merged = (', %d bytes after force-merge' % after_merge[1]) if after_merge else ''
+    print 'Index size: %d bytes before load, %d bytes after load%s' % (before[1], after_load[1], merged)
+
+  # A resumed load counts the documents loaded before it was interrupted, so
+  # its rate is only meaningful for uninterrupted runs.
+  config = {'data': input_file, 'index': index, 'doc_type': doc_type, 'workers': num_workers,
+            'senders': num_senders, 'batch_bytes': batch_bytes, 'batch_latency': batch_latency, 'typed': typed,
+            'cached': cache_dir != '', 'resumed': resume, 'tune': tune, 'max_segments': max_segments}
+  metrics = {'docs/s': successful / elapsed if elapsed else 0.0, 'failed docs': loaded - successful,
+             'elapsed (s)': elapsed}
+  path = results.save(results_dir, 'esload', 'load', label, config, env, metrics,
+                      {'argv': argv, 'seed': seed, 'loaded': loaded, 'successful': successful})
+  if path is not None:
+    print 'Results written to %s' % path
 
 
 if __name__ == '__main__':
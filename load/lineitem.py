@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import sys
+import json
+import getopt
+
+# Column layout of the TPC-H lineitem table, in the order the columns appear in
+# the pipe-delimited data files. Column i is stored as field<i>.
+COLUMNS = [
+  ('orderkey', 'long'),
+  ('partkey', 'long'),
+  ('suppkey', 'long'),
+  ('linenumber', 'integer'),
+  ('quantity', 'integer'),
+  ('extendedprice', 'decimal'),
+  ('discount', 'decimal'),
+  ('tax', 'decimal'),
+  ('returnflag', 'keyword'),
+  ('linestatus', 'keyword'),
+  ('shipdate', 'date'),
+  ('commitdate', 'date'),
+  ('receiptdate', 'date'),
+  ('shipinstruct', 'keyword'),
+  ('shipmode', 'keyword'),
+  ('comment', 'text'),
+]
+
+def date(value):
+  if len(value) != 10 or value[4] != '-' or value[7] != '-':
+    raise ValueError('invalid date: %s' % value)
+  return value
+
+
+CONVERTERS = {
+  'long': int,
+  'integer': int,
+  'decimal': float,
+  'keyword': str,
+  'date': date,
+  'text': str,
+}
+
+MAPPINGS = {
+  'long': {'type': 'long'},
+  'integer': {'type': 'integer'},
+  'decimal': {'type': 'double'},
+  'keyword': {'type': 'string', 'index': 'not_analyzed'},
+  'date': {'type': 'date', 'format': 'yyyy-MM-dd'},
+  'text': {'type': 'string'},
+}
+
+converters = [CONVERTERS[column_type] for _, column_type in COLUMNS]
+
+
+def typed_fields(fields):
+  # Empty columns (such as the one after a trailing '|') are left out, and so
+  # are values that do not parse as their column type, e.g. a header row.
+  doc = {}
+  for i in range(0, len(fields)):
+    value = fields[i]
+    if value == '':
+      continue
+    if i < len(converters):
+      try:
+        value = converters[i](value)
+      except ValueError:
+        continue
+    doc['field%d' % i] = value
+  return doc
+
+
+def index_body(doc_type, shards=16, replicas=0, doc_values=True, source=True):
+  properties = {}
+  for i, (_, column_type) in enumerate(COLUMNS):
+    mapping = dict(MAPPINGS[column_type])
+    if not doc_values and column_type != 'text':
+      mapping['doc_values'] = False
+    properties['field%d' % i] = mapping
+
+  type_mapping = {'properties': properties}
+  if not source:
+    type_mapping['_source'] = {'enabled': False}
+
+  return {
+    'settings': {
+      'number_of_shards': shards,
+      'number_of_replicas': replicas,
+    },
+    'mappings': {
+      doc_type: type_mapping,
+    },
+  }
+
+
+def main(argv):
+  doc_type = 'data'
+  shards = 16
+  replicas = 0
+  doc_values = True
+  source = True
+  help_message = 'lineitem.py -t <type> -s <shards> -r <replicas> --no-doc-values --no-source'
+  try:
+    opts, args = getopt.getopt(argv, 'ht:s:r:', ['type=', 'shards=', 'replicas=', 'no-doc-values', 'no-source'])
+  except getopt.GetoptError:
+    print help_message
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt == '-h':
+      print help_message
+      sys.exit()
+    elif opt in ('-t', '--type'):
+      doc_type = arg
+    elif opt in ('-s', '--shards'):
+      shards = int(arg)
+    elif opt in ('-r', '--replicas'):
+      replicas = int(arg)
+    elif opt == '--no-doc-values':
+      doc_values = False
+    elif opt == '--no-source':
+      source = False
+
+  print json.dumps(index_body(doc_type, shards, replicas, doc_values, source), indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
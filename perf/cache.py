@@ -0,0 +1,136 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Client-side result caches, standing in for an application cache tier in
+# front of the cluster. Entries are raw response bodies, and the caches are
+# bounded by the total size of those bodies. One cache is shared by all the
+# threads of a process.
+CACHE_TYPES = ('lru', 'ttl')
+COUNTERS = ('hits', 'misses', 'evictions', 'expirations', 'invalidations')
+
+
+class LRUCache(object):
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    # Keys of the cached search results of every index, so that an append to
+    # the index can drop them.
+    self.search_keys = {}
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.invalidations = 0
+
+  def expired(self, entry):
+    return False
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None and self.expired(entry):
+        self.remove(key, entry)
+        self.expirations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      # Re-inserting moves the entry to the most recently used end.
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, index=None):
+    size = len(value)
+    if size > self.max_bytes:
+      return
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.remove(key, old)
+      while self.bytes + size > self.max_bytes:
+        evicted_key, evicted = self.entries.popitem(last=False)
+        self.remove(evicted_key, evicted)
+        self.evictions += 1
+      self.entries[key] = (value, index, time.time())
+      self.bytes += size
+      if index is not None:
+        self.search_keys.setdefault(index, set()).add(key)
+
+  def remove(self, key, entry):
+    # Accounting for an entry already popped from entries.
+    self.bytes -= len(entry[0])
+    if entry[1] is not None:
+      self.search_keys[entry[1]].discard(key)
+
+  def invalidate(self, index, key=None):
+    # Called on every append to index: every cached search of the index may
+    # now be stale, and so may a cached lookup of the appended id.
+    with self.lock:
+      keys = self.search_keys.pop(index, set())
+      if key is not None and key in self.entries:
+        keys.add(key)
+      for stale in keys:
+        entry = self.entries.pop(stale, None)
+        if entry is not None:
+          self.bytes -= len(entry[0])
+          self.invalidations += 1
+
+  def stats(self):
+    with self.lock:
+      stats = dict((counter, getattr(self, counter)) for counter in COUNTERS)
+      stats['entries'] = len(self.entries)
+      stats['bytes'] = self.bytes
+      return stats
+
+
+class TTLCache(LRUCache):
+  # An LRU cache whose entries also expire ttl seconds after being stored.
+  def __init__(self, max_bytes, ttl):
+    LRUCache.__init__(self, max_bytes)
+    self.ttl = ttl
+
+  def expired(self, entry):
+    return time.time() - entry[2] > self.ttl
+
+
+def create_cache(params):
+  # params is the workload's "cache" setting: {"type": "lru" or "ttl",
+  # "max_bytes": ..., "ttl": seconds}.
+  if not params:
+    return None
+  cache_type = params.get('type', 'lru')
+  max_bytes = params.get('max_bytes', 64 * 1024 * 1024)
+  if cache_type == 'lru':
+    return LRUCache(max_bytes)
+  elif cache_type == 'ttl':
+    return TTLCache(max_bytes, params.get('ttl', 60.0))
+  raise ValueError('Invalid cache type %s' % cache_type)
+
+
+def merge_stats(all_stats):
+  merged = {}
+  for stats in all_stats:
+    for counter, value in stats.items():
+      merged[counter] = merged.get(counter, 0) + value
+  return merged
+
+
+def phase_stats(start, end):
+  # Counter increases between two stats() snapshots; entries and bytes as of
+  # the later one.
+  stats = dict((counter, end[counter] - start[counter]) for counter in COUNTERS)
+  stats['entries'] = end['entries']
+  stats['bytes'] = end['bytes']
+  return stats
+
+
+def summary(stats):
+  lookups = stats['hits'] + stats['misses']
+  hit_rate = 100.0 * stats['hits'] / lookups if lookups else 0.0
+  return ('%d hits, %d misses (%.1f%% hit rate), %d evictions, %d expirations, %d invalidations, '
+          '%d entries, %d bytes' % (stats['hits'], stats['misses'], hit_rate, stats['evictions'],
+                                    stats['expirations'], stats['invalidations'], stats['entries'], stats['bytes']))
@@ -0,0 +1,49 @@
+import time
+import threading
+
+# A monotonic clock in seconds for timing requests and phases. Python 3 has
+# time.perf_counter; on Python 2 CLOCK_MONOTONIC is read through ctypes,
+# with time.time as the last resort. SOURCE names the clock in use.
+CLOCK_MONOTONIC = 1
+
+now = getattr(time, 'perf_counter', None)
+SOURCE = 'perf_counter'
+
+if now is None:
+  try:
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    # No argtypes: checking them more than doubles the cost of a call.
+    clock_gettime = librt.clock_gettime
+    # Every thread reads the clock into its own timespec.
+    local = threading.local()
+
+    def now():
+      try:
+        ts, ts_ref = local.ts
+      except AttributeError:
+        ts = timespec()
+        ts_ref = ctypes.byref(ts)
+        local.ts = (ts, ts_ref)
+      clock_gettime(CLOCK_MONOTONIC, ts_ref)
+      return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0:
+      raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+    SOURCE = 'clock_gettime(CLOCK_MONOTONIC)'
+  except (ImportError, OSError, AttributeError, TypeError):
+    now = time.time
+    SOURCE = 'time.time (not monotonic)'
+
+
+def read_cost(reads=100000):
+  # Average cost of one clock read, in nanoseconds.
+  start = now()
+  for _ in xrange(reads):
+    now()
+  return (now() - start) / reads * 1e9
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import socket
+
+connect_timeout = 60.0
+
+# Coordinator and workers exchange newline-delimited JSON messages over TCP:
+#
+#   worker      -> coordinator  {"type": "hello", "host": ..., "pid": ...}
+#   coordinator -> worker       {"type": "prepare", "config": {...}}
+#   worker      -> coordinator  {"type": "ready"}
+#   coordinator -> worker       {"type": "start", "delay": <secs>}
+#   worker      -> coordinator  {"type": "result", ...}
+#   coordinator -> worker       {"type": "exit"}
+#
+# A worker starts its warmup phase <delay> seconds after receiving "start",
+# which is sent to every worker at once after all of them are ready, so the
+# phases line up across processes and hosts without synchronized clocks.
+
+
+class Channel(object):
+  def __init__(self, sock):
+    self.sock = sock
+    self.reader = sock.makefile('r')
+
+  def send(self, message):
+    self.sock.sendall(json.dumps(message) + '\n')
+
+  def recv(self):
+    line = self.reader.readline()
+    if not line:
+      raise IOError('Connection closed by peer')
+    return json.loads(line)
+
+  def close(self):
+    self.reader.close()
+    self.sock.close()
+
+
+class Coordinator(object):
+  def __init__(self, port, expected):
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind(('', port))
+    self.server.listen(max(expected, 1))
+    self.port = self.server.getsockname()[1]
+    self.expected = expected
+    self.workers = []
+
+  def accept(self):
+    while len(self.workers) < self.expected:
+      sock, address = self.server.accept()
+      worker = Channel(sock)
+      hello = worker.recv()
+      worker.name = '%s/%d' % (hello['host'], hello['pid'])
+      self.workers.append(worker)
+      print '[Coordinator] Worker %s connected from %s (%d/%d).' % (worker.name, address[0], len(self.workers),
+                                                                    self.expected)
+
+  def run(self, config, delay, on_start=None):
+    # on_start is called with the time the workers' warmup phases start, just
+    # before "start" is sent.
+    for worker in self.workers:
+      worker.send({'type': 'prepare', 'config': config})
+    for worker in self.workers:
+      worker.recv()
+    print '[Coordinator] All workers ready, starting in %.1f seconds...' % delay
+    if on_start is not None:
+      on_start(time.time() + delay)
+    for worker in self.workers:
+      worker.send({'type': 'start', 'delay': delay})
+    results = []
+    for worker in self.workers:
+      result = worker.recv()
+      result['worker'] = worker.name
+      results.append(result)
+    return results
+
+  def close(self):
+    # Best effort: called on the way out, also after a failure, so a worker
+    # whose connection is already gone must not hide the original error.
+    for worker in self.workers:
+      try:
+        worker.send({'type': 'exit'})
+      except socket.error:
+        pass
+      try:
+        worker.close()
+      except socket.error:
+        pass
+    self.server.close()
+
+
+def connect(address):
+  # Workers may be launched before the coordinator is listening, so refused
+  # connections are retried for a while.
+  host, port = address.rsplit(':', 1)
+  deadline = time.time() + connect_timeout
+  while True:
+    try:
+      sock = socket.create_connection((host, int(port)))
+      break
+    except socket.error:
+      if time.time() > deadline:
+        raise
+      time.sleep(1.0)
+  coordinator = Channel(sock)
+  coordinator.send({'type': 'hello', 'host': socket.gethostname(), 'pid': os.getpid()})
+  return coordinator
@@ -3,38 +3,219 @@
 import sys
 import getopt
 import random
-from datetime import datetime
 from elasticsearch import Elasticsearch
+import clock
+import histogram
+import keys
+import nodestats
+import querygen
+import results
 
 es = None
+scroll_keepalive = '1m'
 
 
-def us(td):
-  return (td.days * 24 * 60 * 60 + td.seconds) * 1000 * 1000 + td.microseconds
+def us(seconds):
+  # Clock readings are in seconds; latencies are whole microseconds.
+  return int(seconds * 1000 * 1000)
+
+
+def bench_mget(ids, index, doc_type, batch_size):
+  # Looks up the ids batch_size at a time. Returns the per-batch latencies,
+  # the per-document share of them, and the number of documents and total
+  # time for documents/sec.
+  batch_latencies = histogram.LatencyHistogram()
+  doc_latencies = histogram.LatencyHistogram()
+  total_time = 0
+  for i in range(0, len(ids), batch_size):
+    batch = ids[i:i + batch_size]
+    start = clock.now()
+    res = es.mget(index=index, doc_type=doc_type, body={'ids': batch})
+    found = sum(1 for doc in res['docs'] if doc.get('found'))
+    end = clock.now()
+    latency = us(end - start)
+    batch_latencies.record(latency)
+    for _ in batch:
+      doc_latencies.record(latency / len(batch))
+    total_time += latency
+    print '%d\t%d\t%d' % (len(batch), found, latency)
+  return batch_latencies, doc_latencies, len(ids), total_time
+
+
+def parse_query(line):
+  return querygen.parse_query_line(line)[1]
 
 
 def bench_search(query_file, index):
+  # Returns the latencies of all queries and those of each template, for
+  # query files written by querygen.py.
+  latencies = histogram.LatencyHistogram()
+  template_latencies = {}
   with open(query_file) as ifp:
     for line in ifp:
-      field_id, query = line.strip().split('|', 2)
+      template, qbody = querygen.parse_query_line(line)
+      qbody.setdefault('size', 100000)
+      qbody.setdefault('fields', [])
       count = 0
-      start = datetime.now()
-      qbody = {'query': {'match': {'field%s' % field_id: query}}}
-      res = es.search(index=index, body=qbody, fields=[], size=100000)
+      start = clock.now()
+      res = es.search(index=index, body=qbody)
       for _ in res['hits']['hits']:
         count += 1
-      end = datetime.now()
+      end = clock.now()
+      latencies.record(us(end - start))
+      if template is not None:
+        template_latencies.setdefault(template, histogram.LatencyHistogram()).record(us(end - start))
       print '%d\t%d' % (count, us(end - start))
+  return latencies, template_latencies
 
 
-def bench_get(record_count, index, doc_type):
-  ids = random.sample(range(0, record_count), min(100000, record_count))
+def sample_ids(record_count, distribution='uniform', exponent=0.99, hot_requests=0.8, hot_keys=0.2):
+  count = min(100000, record_count)
+  if distribution == 'uniform':
+    return random.sample(xrange(0, record_count), count)
+  elif distribution == 'latest':
+    return [record_count - 1 - i for i in keys.sample_keys(distribution, count, record_count, exponent)]
+  return keys.sample_keys(distribution, count, record_count, exponent, hot_requests, hot_keys)
+
+
+def bench_get(ids, index, doc_type):
+  latencies = histogram.LatencyHistogram()
   for i in ids:
-    start = datetime.now()
+    start = clock.now()
     res = es.get(index=index, doc_type=doc_type, id=i)
     length = len(res['_source'])
-    end = datetime.now()
+    end = clock.now()
+    latencies.record(us(end - start))
     print '%d\t%s\t%d' % (i, length, us(end - start))
+  return latencies
+
+
+def drain_scroll(index, qbody, page_size, page_latencies):
+  # Pages through every hit of the query, keeping only counts. Returns the
+  # hit count, number of requests, time to the first page and total time.
+  count = 0
+  pages = 1
+  start = clock.now()
+  res = es.search(index=index, body=qbody, scroll=scroll_keepalive, size=page_size, sort='_doc', fields=[])
+  first_page = us(clock.now() - start)
+  page_latencies.record(first_page)
+  scroll_id = res.get('_scroll_id')
+  hits = len(res['hits']['hits'])
+  try:
+    while hits:
+      count += hits
+      page_start = clock.now()
+      res = es.scroll(scroll_id=scroll_id, scroll=scroll_keepalive)
+      page_latencies.record(us(clock.now() - page_start))
+      pages += 1
+      scroll_id = res.get('_scroll_id', scroll_id)
+      hits = len(res['hits']['hits'])
+  finally:
+    if scroll_id is not None:
+      es.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+  return count, pages, first_page, us(clock.now() - start)
+
+
+def drain_search_after(index, qbody, page_size, sort_field, page_latencies):
+  # Same as drain_scroll, but each page is a fresh search starting after the
+  # sort values of the previous page's last hit (Elasticsearch 5.0+).
+  body = dict(qbody)
+  body['sort'] = [{sort_field: 'asc'}]
+  count = 0
+  pages = 0
+  first_page = None
+  start = clock.now()
+  while True:
+    page_start = clock.now()
+    res = es.search(index=index, body=body, size=page_size, fields=[])
+    latency = us(clock.now() - page_start)
+    page_latencies.record(latency)
+    pages += 1
+    if first_page is None:
+      first_page = latency
+    hits = res['hits']['hits']
+    count += len(hits)
+    if len(hits) < page_size:
+      break
+    body['search_after'] = hits[-1]['sort']
+  return count, pages, first_page, us(clock.now() - start)
+
+
+def bench_paginate(query_file, index, page_size, bench_type, sort_field):
+  first_pages = histogram.LatencyHistogram()
+  page_latencies = histogram.LatencyHistogram()
+  total_hits = 0
+  total_time = 0
+  with open(query_file) as ifp:
+    for line in ifp:
+      qbody = parse_query(line)
+      if bench_type == 'scroll':
+        count, pages, first_page, elapsed = drain_scroll(index, qbody, page_size, page_latencies)
+      else:
+        count, pages, first_page, elapsed = drain_search_after(index, qbody, page_size, sort_field, page_latencies)
+      first_pages.record(first_page)
+      total_hits += count
+      total_time += elapsed
+      print '%d\t%d\t%d\t%d\t%d' % (page_size, count, pages, first_page, elapsed)
+  return first_pages, page_latencies, total_hits, total_time
+
+
+def run_benchmark(bench_type, query_file, index, doc_type, record_count, distribution, exponent, hot_requests,
+                  hot_keys, page_sizes, batch_sizes, sort_field):
+  # Returns the latency histograms and rates measured, by name, for the
+  # result record.
+  if bench_type == 'search':
+    latencies, template_latencies = bench_search(query_file, index)
+  elif bench_type == 'get':
+    template_latencies = {}
+    ids = sample_ids(record_count, distribution, exponent, hot_requests, hot_keys)
+    latencies = bench_get(ids, index, doc_type)
+  elif bench_type == 'mget':
+    histograms = {}
+    rates = {}
+    ids = sample_ids(record_count, distribution, exponent, hot_requests, hot_keys)
+    for batch_size in batch_sizes:
+      batch_latencies, doc_latencies, docs, total_time = bench_mget(ids, index, doc_type, batch_size)
+      throughput = docs / (total_time / 1000.0 / 1000.0) if total_time else 0.0
+      print >> sys.stderr, 'mget batch size %d: %d batches, %.2f docs/s, latency per batch (us) %s' % (
+        batch_size, batch_latencies.count, throughput, histogram.summary(batch_latencies))
+      print >> sys.stderr, 'mget batch size %d: latency per doc (us) %s' % (batch_size,
+                                                                          histogram.summary(doc_latencies))
+      histograms['mget batch %d' % batch_size] = batch_latencies
+      histograms['mget batch %d per doc' % batch_size] = doc_latencies
+      rates['mget batch %d docs/s' % batch_size] = throughput
+    return histograms, rates
+  else:
+    histograms = {}
+    rates = {}
+    for page_size in page_sizes:
+      first_pages, page_latencies, total_hits, total_time = bench_paginate(query_file, index, page_size, bench_type,
+                                                                           sort_field)
+      throughput = total_hits / (total_time / 1000.0 / 1000.0) if total_time else 0.0
+      print >> sys.stderr, '%s page size %d: %d queries, %d hits in %d pages, %.2f hits/s' % (
+        bench_type, page_size, first_pages.count, total_hits, page_latencies.count, throughput)
+      print >> sys.stderr, '%s page size %d: time to first page (us) %s' % (bench_type, page_size,
+                                                                           histogram.summary(first_pages))
+      print >> sys.stderr, '%s page size %d: page latency (us) %s' % (bench_type, page_size,
+                                                                      histogram.summary(page_latencies))
+      histograms['%s page size %d first page' % (bench_type, page_size)] = first_pages
+      histograms['%s page size %d page' % (bench_type, page_size)] = page_latencies
+      rates['%s page size %d hits/s' % (bench_type, page_size)] = throughput
+    return histograms, rates
+
+  # The summary goes to stderr so that stdout keeps one line per request.
+  print >> sys.stderr, '%s: %d requests, latency (us) %s' % (bench_type, latencies.count,
+                                                            histogram.summary(latencies))
+  for template in sorted(template_latencies):
+    print >> sys.stderr, '%s %s: %d requests, latency (us) %s' % (bench_type, template,
+                                                                template_latencies[template].count,
+                                                                histogram.summary(template_latencies[template]))
+  histograms = dict(('%s %s' % (bench_type, template), template_latencies[template])
+                    for template in template_latencies)
+  histograms[bench_type] = latencies
+  rates = {'%s requests/s' % bench_type: latencies.count / (latencies.total / 1000.0 / 1000.0) if latencies.total
+           else 0.0}
+  return histograms, rates
 
 
 def main(argv):
@@ -43,9 +224,27 @@ def main(argv):
   index = 'bench'
   doc_type = 'data'
   bench_type = 'search'
-  help_msg = 'esbench.py -e <es-server> -q <queries> -i <index> -t <doc-type> -b <bench-type>'
+  distribution = 'uniform'
+  exponent = 0.99
+  hot_requests = 0.8
+  hot_keys = 0.2
+  page_sizes = [1000]
+  batch_sizes = [10]
+  sort_field = '_uid'
+  node_stats = ''
+  results_dir = results.RESULTS_DIR
+  label = ''
+  stats_interval = 5.0
+  help_msg = ('esbench.py -e <es-server> -q <queries> -i <index> -t <doc-type> -b <bench-type> '
+              '-d <uniform|zipfian|hotspot|latest> -z <zipf-exponent> -H <hot-requests-pct,hot-keys-pct> '
+              '-P <page-size[,page-size...]> -S <sort-field> -B <batch-size[,batch-size...]> '
+              '-N <node-stats-file> -V <stats-interval-secs> -O <results-dir> --label <label>')
   try:
-    opts, args = getopt.getopt(argv, 'he:q:i:t:b:', ['es-server', 'queries=', 'index=', 'type=', 'benchtype='])
+    opts, args = getopt.getopt(argv, 'he:q:i:t:b:d:z:H:P:S:B:N:V:O:', ['es-server', 'queries=', 'index=', 'type=',
+                                                                    'benchtype=', 'distribution=', 'zipf-exponent=',
+                                                                    'hotspot=', 'page-size=', 'sort-field=',
+                                                                    'batch-size=', 'node-stats=', 'stats-interval=',
+                                                                    'results-dir=', 'label='])
   except getopt.GetoptError:
     print help_msg
     sys.exit(2)
@@ -63,7 +262,35 @@ def main(argv):
       doc_type = arg
     elif opt in ('-b', '--benchtype'):
       bench_type = arg
-  if bench_type == 'search' and query_file == '':
+    elif opt in ('-d', '--distribution'):
+      distribution = arg
+    elif opt in ('-z', '--zipf-exponent'):
+      exponent = float(arg)
+    elif opt in ('-H', '--hotspot'):
+      hot_requests, hot_keys = arg.split(',')
+      hot_requests = float(hot_requests) / 100.0
+      hot_keys = float(hot_keys) / 100.0
+    elif opt in ('-P', '--page-size'):
+      page_sizes = [int(page_size) for page_size in arg.split(',')]
+    elif opt in ('-S', '--sort-field'):
+      sort_field = arg
+    elif opt in ('-B', '--batch-size'):
+      batch_sizes = [int(batch_size) for batch_size in arg.split(',')]
+    elif opt in ('-N', '--node-stats'):
+      node_stats = arg
+    elif opt in ('-V', '--stats-interval'):
+      stats_interval = float(arg)
+    elif opt in ('-O', '--results-dir'):
+      results_dir = arg
+    elif opt == '--label':
+      label = arg
+  if bench_type not in ('search', 'get', 'mget', 'scroll', 'search-after'):
+    print 'Error: Invalid benchtype %s' % bench_type
+    sys.exit(2)
+  if distribution not in keys.DISTRIBUTIONS:
+    print 'Error: Invalid key distribution %s' % distribution
+    sys.exit(2)
+  if bench_type in ('search', 'scroll', 'search-after') and query_file == '':
     print 'Error: Must specify query-file for search benchmark!'
     sys.exit(2)
 
@@ -71,11 +298,32 @@ def main(argv):
   global es
   es = Elasticsearch(hosts=[host], timeout=600)
   record_count = es.count(index=index)['count']
+  env = results.environment(es, index)
 
-  if bench_type == 'search':
-    bench_search(query_file, index)
-  elif bench_type == 'get':
-    bench_get(record_count, index, doc_type)
+  sampler = None
+  if node_stats != '':
+    sampler = nodestats.NodeStatsSampler(Elasticsearch(hosts=[host], timeout=600), stats_interval)
+    sampler.start()
+  try:
+    histograms, rates = run_benchmark(bench_type, query_file, index, doc_type, record_count, distribution, exponent,
+                                      hot_requests, hot_keys, page_sizes, batch_sizes, sort_field)
+  finally:
+    if sampler is not None:
+      sampler.stop()
+      sampler.report(bench_type, node_stats, {'benchtype': bench_type}, out=sys.stderr)
+
+  metrics = dict(rates)
+  for name, latencies in histograms.items():
+    metrics.update(results.latency_metrics(name, latencies))
+  config = {'benchtype': bench_type, 'queries': query_file, 'index': index, 'doc_type': doc_type,
+            'record_count': record_count, 'distribution': distribution, 'exponent': exponent,
+            'hot_requests': hot_requests, 'hot_keys': hot_keys, 'page_sizes': page_sizes, 'batch_sizes': batch_sizes,
+            'sort_field': sort_field}
+  path = results.save(results_dir, 'eslatency', bench_type, label, config, env, metrics,
+                      {'argv': argv, 'latencies': dict((name, latencies.to_dict())
+                                                       for name, latencies in histograms.items())})
+  if path is not None:
+    print >> sys.stderr, 'Results written to %s' % path
 
 
 if __name__ == '__main__':
@@ -1,15 +1,45 @@
 #!/usr/bin/python
 
-import os
 import sys
+
+
+def async_engine(argv):
+  for i in range(0, len(argv)):
+    if argv[i] in ('-g', '--engine') and i + 1 < len(argv) and argv[i + 1] == 'async':
+      return True
+    if argv[i] in ('-gasync', '--engine=async'):
+      return True
+  return False
+
+
+# The async engine runs every benchmark thread as a greenlet sharing one
+# client and connection pool. The standard library has to be patched before
+# anything else imports socket or threading.
+if async_engine(sys.argv[1:]):
+  from gevent import monkey
+  monkey.patch_all()
+
+import os
 import getopt
-import random
+import time
 import socket
 import threading
-from datetime import datetime
+import multiprocessing
 from elasticsearch import Elasticsearch
+import clock
+import histogram
+import distributed
+import workload
+import cache as result_cache
+import nodestats
+import results
+import sweep
+
 
 writeLock = threading.Lock()
+start_delay = 5.0
+# A rate sweep stops after this many steps even if the SLO still holds.
+max_sweep_steps = 100
 
 if os.name != "nt":
     import fcntl
@@ -43,417 +73,431 @@ def get_ip():
     return ip
 
 
-def secs(td):
-  return (float(td.days) * 24.0 * 60.0 * 60.0 + float(td.seconds)) + float(td.microseconds) / (1000.0 * 1000.0)
-
-
 class BenchmarkThread(threading.Thread):
-  def __init__(self, thread_id, bench_type, es_server, index, doc_type, queries, record_count):
+  def __init__(self, thread_id, name, operations, weights, rate=0.0, offset=0.0, interval=1.0):
     threading.Thread.__init__(self)
     self.thread_id = thread_id
-    self.bench_type = bench_type
-    self.index = index
-    self.doc_type = doc_type
-    self.queries = queries
-    self.record_count = record_count
-    print '[Thread %d] Connecting to ES...' % thread_id
-    self.es = Elasticsearch(hosts=['http://%s:9200' % es_server], timeout=600)
-    print '[Thread %d] Connected.' % thread_id
-    self.query_count = len(queries)
+    self.workload_name = name
+    self.operations = operations
+    self.cache = None
+    self.cache_stats = None
+    self.order = [operations[i] for i in workload.schedule(weights)]
+    self.order_count = len(self.order)
     self.WARMUP_TIME = 60
     self.MEASURE_TIME = 120
     self.COOLDOWN_TIME = 60
-
-  def bench_get(self):
-    print '[Thread %d] Benchmarking get...' % self.thread_id
-
-    qid = 0
-
-    # Warmup
-    print '[Thread %d] Warmup phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.WARMUP_TIME:
-      query = self.queries[qid]
-      self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      qid = (qid + 1) % self.query_count
-
-    # Measure
-    print '[Thread %d] Measure phase...' % self.thread_id
+    # With a target rate, requests are issued open-loop on a fixed schedule of
+    # one request per interval, starting offset seconds into each phase so
+    # that threads do not fire in lock-step.
+    self.interval = 1.0 / rate if rate > 0 else 0.0
+    self.offset = offset
+    # When set, phases start at fixed wall-clock offsets from start_time so
+    # that they line up with the other processes of a distributed run.
+    self.start_time = None
+    self.recorder = histogram.LatencyRecorder(interval)
+    self.throughput = 0.0
+    self.counters = {}
+    self.qid = 0
+
+  def step(self):
+    operation = self.order[self.qid]
+    self.qid = (self.qid + 1) % self.order_count
+    operation.run()
+    return operation.name
+
+  def run_phase(self, duration, measure):
+    # One clock read per request: the read that ends a request also starts
+    # the next one. Times are in seconds from the start of the phase.
     query_count = 0
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.MEASURE_TIME:
-      query = self.queries[qid]
-      self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      qid = (qid + 1) % self.query_count
-      query_count += 1
-
-    total_time = secs(datetime.now() - start)
-    throughput = float(query_count) / total_time
-
-    # Cooldown
-    print '[Thread %d] Cooldown phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.COOLDOWN_TIME:
-      query = self.queries[qid]
-      self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      qid = (qid + 1) % self.query_count
-
-    print '[Thread %d] Benchmark complete.' % self.thread_id
-    return throughput
-
-  def bench_search(self):
-    print '[Thread %d] Benchmarking search...' % self.thread_id
-
-    qid = 0
+    now = clock.now
+    start = now()
+    deadline = start + duration
+    if self.interval > 0:
+      # Latency is taken from the time a request was scheduled to go out, not
+      # from when it was actually sent, so time spent queued behind slow
+      # responses is not hidden (coordinated omission).
+      scheduled = start + self.offset
+      while scheduled < deadline:
+        delay = scheduled - now()
+        if delay > 0:
+          time.sleep(delay)
+        op = self.step()
+        if measure:
+          self.recorder.record(op, (now() - scheduled) * 1000000.0, scheduled - start)
+        query_count += 1
+        scheduled += self.interval
+    else:
+      sent = start
+      while sent < deadline:
+        op = self.step()
+        done = now()
+        if measure:
+          self.recorder.record(op, (done - sent) * 1000000.0, sent - start)
+        query_count += 1
+        sent = done
+    return query_count, now() - start
+
+  def wait_for_phase(self, phase_start):
+    if self.start_time is not None:
+      delay = self.start_time + phase_start - time.time()
+      if delay > 0:
+        time.sleep(delay)
+
+  def run_benchmark(self):
+    print '[Thread %d] Benchmarking %s...' % (self.thread_id, self.workload_name)
 
     # Warmup
+    self.wait_for_phase(0)
     print '[Thread %d] Warmup phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.WARMUP_TIME:
-      query = self.queries[qid]
-      count = 0
-      res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-      for _ in res['hits']['hits']:
-        count += 1
-      qid = (qid + 1) % self.query_count
+    self.run_phase(self.WARMUP_TIME, False)
 
     # Measure
+    self.wait_for_phase(self.WARMUP_TIME)
     print '[Thread %d] Measure phase...' % self.thread_id
-    query_count = 0
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.MEASURE_TIME:
-      query = self.queries[qid]
-      count = 0
-      res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-      for _ in res['hits']['hits']:
-        count += 1
-      qid = (qid + 1) % self.query_count
-      query_count += 1
-
-    total_time = secs(datetime.now() - start)
+    workload.reset_counters(self.operations)
+    cache_start = self.cache.stats() if self.cache is not None else None
+    query_count, total_time = self.run_phase(self.MEASURE_TIME, True)
+    self.counters = workload.operation_counters(self.operations)
+    if self.cache is not None:
+      self.cache_stats = result_cache.phase_stats(cache_start, self.cache.stats())
     throughput = float(query_count) / total_time
 
     # Cooldown
+    self.wait_for_phase(self.WARMUP_TIME + self.MEASURE_TIME)
     print '[Thread %d] Cooldown phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.COOLDOWN_TIME:
-      query = self.queries[qid]
-      count = 0
-      res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-      for _ in res['hits']['hits']:
-        count += 1
-      qid = (qid + 1) % self.query_count
+    self.run_phase(self.COOLDOWN_TIME, False)
 
     print '[Thread %d] Benchmark complete.' % self.thread_id
-
     return throughput
-    
-  def bench_search_append(self):
-    print '[Thread %d] Benchmarking search+append...' % self.thread_id
-
-    qid = 0
-    aid = self.record_count + 1
-
-    # Warmup
-    print '[Thread %d] Warmup phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.WARMUP_TIME:
-      query = self.queries[qid]
-      if qid % 20 == 0:
-        self.es.index(index=self.index, doc_type=self.doc_type, id=str(aid), body=query)
-        aid += 1
-      else:
-        count = 0
-        res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-        for _ in res['hits']['hits']:
-          count += 1
-      qid = (qid + 1) % self.query_count
-
-    # Measure
-    print '[Thread %d] Measure phase...' % self.thread_id
-    query_count = 0
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.MEASURE_TIME:
-      query = self.queries[qid]
-      if qid % 20 == 0:
-        self.es.index(index=self.index, doc_type=self.doc_type, id=str(aid), body=query)
-        aid += 1
-      else:
-        count = 0
-        res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-        for _ in res['hits']['hits']:
-          count += 1
-      qid = (qid + 1) % self.query_count
-      query_count += 1
-
-    total_time = secs(datetime.now() - start)
-    throughput = float(query_count) / total_time
 
-    # Cooldown
-    print '[Thread %d] Cooldown phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.COOLDOWN_TIME:
-      query = self.queries[qid]
-      if qid % 20 == 0:
-        self.es.index(index=self.index, doc_type=self.doc_type, id=str(aid), body=query)
-        aid += 1
-      else:
-        count = 0
-        res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-        for _ in res['hits']['hits']:
-          count += 1
-      qid = (qid + 1) % self.query_count
+  def run(self):
+    throughput = self.run_benchmark()
+    self.throughput = throughput
+    writeLock.acquire()
+    with open('thput', 'a') as out:
+      out.write('%d\t%.2f\n' % (self.thread_id, throughput))
+    self.recorder.report('Thread %d' % self.thread_id, self.MEASURE_TIME, series=False)
+    writeLock.release()
 
-    print '[Thread %d] Benchmark complete.' % self.thread_id
 
-    return throughput
-    
-  def bench_get_append(self):
-    print '[Thread %d] Benchmarking get+append...' % self.thread_id
+class SweepThread(BenchmarkThread):
+  # A thread of a concurrency sweep: runs every generation of the sweep that
+  # it is active in, until the sweep is done.
+  def __init__(self, controller, **kwargs):
+    BenchmarkThread.__init__(self, **kwargs)
+    self.daemon = True
+    self.controller = controller
+    self.completed = 0
+
+  def run_generation(self, generation, measure):
+    controller = self.controller
+    recorder = histogram.LatencyRecorder(self.recorder.interval)
+    if measure:
+      workload.reset_counters(self.operations)
+    now = clock.now
+    start = controller.start
+    sent = now()
+    try:
+      while controller.generation == generation:
+        op = self.step()
+        done = now()
+        if measure:
+          recorder.record(op, (done - sent) * 1000000.0, sent - start)
+        self.completed += 1
+        sent = done
+    except Exception:
+      controller.fail()
+    finally:
+      # A thread that entered a measured generation always hands in, or the
+      # controller would wait for it forever.
+      if measure:
+        controller.hand_in(generation, (recorder, workload.operation_counters(self.operations)))
 
-    qid = 0
-    aid = self.record_count + 1
+  def run(self):
+    generation = 0
+    while self.controller.error is None:
+      generation, measure = self.controller.wait(self.thread_id, generation)
+      if generation is None:
+        break
+      self.run_generation(generation, measure)
+
+
+def create_threads(config, controller=None):
+  num_threads = config['num_threads']
+  rate = config['rate']
+  shared_es = None
+  if config['engine'] == 'async':
+    shared_es = Elasticsearch(hosts=['http://%s:9200' % config['es_server']], timeout=600, maxsize=num_threads)
+
+  # The corpora are loaded once and shared read-only by all threads.
+  print '[Main Thread] Loading queries...'
+  corpora = workload.load_corpora(config['workload'], config['record_count'], config['typed'])
+  coalescers = workload.create_coalescers(config['workload'], config['index'], config['doc_type'])
+  cache = workload.create_cache(config['workload'])
 
-    # Warmup
-    print '[Thread %d] Warmup phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.WARMUP_TIME:
-      query = self.queries[qid]
-      if qid % 20 == 0:
-        self.es.index(index=self.index, doc_type=self.doc_type, id=str(aid), body=query)
-        aid += 1
-      else:
-        count = 0
-        self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      qid = (qid + 1) % self.query_count
+  spec = config['workload']
+  weights = [operation.get('weight', 1) for operation in spec['operations']]
+  threads = []
+  print '[Main Thread] Initializing %d threads...' % num_threads
+  thread_rate = float(rate) / num_threads
+  for i in range(0, num_threads):
+    offset = float(i) / num_threads / thread_rate if rate > 0 else 0.0
+    es = shared_es
+    if es is None:
+      print '[Thread %d] Connecting to ES...' % i
+      es = Elasticsearch(hosts=['http://%s:9200' % config['es_server']], timeout=600)
+      print '[Thread %d] Connected.' % i
+    operations = workload.create_operations(spec, corpora, es, config['index'], config['doc_type'],
+                                            config['record_count'], i, num_threads, coalescers, cache)
+    if controller is not None:
+      thread = SweepThread(controller, thread_id=i, name=spec.get('name', 'workload'), operations=operations,
+                           weights=weights, interval=config['interval'])
+    else:
+      thread = BenchmarkThread(thread_id=i, name=spec.get('name', 'workload'), operations=operations,
+                               weights=weights, rate=thread_rate, offset=offset, interval=config['interval'])
+    thread.cache = cache
+    thread.WARMUP_TIME, thread.MEASURE_TIME, thread.COOLDOWN_TIME = config['phases']
+    threads.append(thread)
+  return threads
 
-    # Measure
-    print '[Thread %d] Measure phase...' % self.thread_id
-    query_count = 0
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.MEASURE_TIME:
-      query = self.queries[qid]
-      if qid % 20 == 0:
-        self.es.index(index=self.index, doc_type=self.doc_type, id=str(aid), body=query)
-        aid += 1
-      else:
-        count = 0
-        self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      qid = (qid + 1) % self.query_count
-      query_count += 1
-
-    total_time = secs(datetime.now() - start)
-    throughput = float(query_count) / total_time
 
-    # Cooldown
-    print '[Thread %d] Cooldown phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.COOLDOWN_TIME:
-      query = self.queries[qid]
-      if qid % 20 == 0:
-        self.es.index(index=self.index, doc_type=self.doc_type, id=str(aid), body=query)
-        aid += 1
-      else:
-        count = 0
-        self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      qid = (qid + 1) % self.query_count
+class NoopOperation(object):
+  name = 'noop'
 
-    print '[Thread %d] Benchmark complete.' % self.thread_id
-
-    return throughput
+  def run(self):
+    pass
 
-  def bench_get_search(self):
-    print '[Thread %d] Benchmarking get+search...' % self.thread_id
 
-    qid = 0
+def calibrate(duration=0.5):
+  # Runs the phase loop over an operation that does nothing, to show how much
+  # of every measured latency is the harness itself.
+  thread = BenchmarkThread(thread_id=-1, name='calibration', operations=[NoopOperation()], weights=[1])
+  unmeasured, unmeasured_time = thread.run_phase(duration, False)
+  measured, measured_time = thread.run_phase(duration, True)
+  print '[Main Thread] Timing: %s clock, %d ns per clock read, %d ns per operation measured / %d unmeasured' % (
+    clock.SOURCE, clock.read_cost(), measured_time / measured * 1e9, unmeasured_time / unmeasured * 1e9)
 
-    # Warmup
-    print '[Thread %d] Warmup phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.WARMUP_TIME:
-      query = self.queries[qid]
-      if qid % 2 == 0:
-        query = self.queries[qid]
-        self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      else:
-        count = 0
-        res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-        for _ in res['hits']['hits']:
-          count += 1
-      qid = (qid + 1) % self.query_count
 
-    # Measure
-    print '[Thread %d] Measure phase...' % self.thread_id
-    query_count = 0
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.MEASURE_TIME:
-      query = self.queries[qid]
-      if qid % 2 == 0:
-        query = self.queries[qid]
-        self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      else:
-        count = 0
-        res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-        for _ in res['hits']['hits']:
-          count += 1
-      qid = (qid + 1) % self.query_count
-      query_count += 1
-
-    total_time = secs(datetime.now() - start)
-    throughput = float(query_count) / total_time
+def join_threads(threads, start_time=None):
+  print '[Main Thread] Starting threads...'
+  for thread in threads:
+    thread.start_time = start_time
+    thread.start()
 
-    # Cooldown
-    print '[Thread %d] Cooldown phase...' % self.thread_id
-    start = datetime.now()
-    while secs(datetime.now() - start) < self.COOLDOWN_TIME:
-      query = self.queries[qid]
-      if qid % 2 == 0:
-        query = self.queries[qid]
-        self.es.get(index=self.index, doc_type=self.doc_type, id=query)
-      else:
-        count = 0
-        res = self.es.search(index=self.index, body=query, fields=[], size=10000)
-        for _ in res['hits']['hits']:
-          count += 1
-      qid = (qid + 1) % self.query_count
+  print '[Main Thread] Waiting for threads to join...'
+  for thread in threads:
+    thread.join()
 
-    print '[Thread %d] Benchmark complete.' % self.thread_id
+  throughput = sum(thread.throughput for thread in threads)
+  recorder = histogram.LatencyRecorder(threads[0].recorder.interval)
+  for thread in threads:
+    recorder.merge(thread.recorder)
+  return throughput, recorder
 
-    return throughput
 
-  def run(self):
-    if self.bench_type == 'get':
-      throughput = self.bench_get()
-    elif self.bench_type == 'search':
-      throughput = self.bench_search()
-    elif self.bench_type == 'search-append':
-      throughput = self.bench_search_append()
-    elif self.bench_type == 'get-append':
-      throughput = self.bench_get_append()
-    elif self.bench_type == 'get-search':
-      throughput = self.bench_get_search()
+def operation_counters(threads):
+  counters = {}
+  for thread in threads:
+    workload.merge_counters(counters, thread.counters)
+  return counters
+
+
+def cache_stats(threads):
+  # The cache is shared by the threads of a process, so its counters over the
+  # measure phase are taken from the first thread's; the others' measure
+  # phases cover the same period.
+  return threads[0].cache_stats
+
+
+def report(source, throughput, recorder, config, series=True, cache_stats=None, counters=None):
+  print '[%s] Throughput: %.2f ops/s' % (source, throughput)
+  if cache_stats is not None:
+    # Cache counters cover the measure phase only, like the bulk counters.
+    print '[%s] Cache: %s' % (source, result_cache.summary(cache_stats))
+  if config['rate'] > 0:
+    print '[%s] Latency (us) at %.2f ops/s target: %s' % (source, config['rate'],
+                                                          histogram.summary(recorder.overall()))
+  recorder.report(source, config['phases'][1], series)
+  for operation in config['workload']['operations']:
+    latencies = recorder.ops.get(operation.get('name', operation['type']))
+    if operation['type'] == 'mget' and latencies is not None and latencies.count:
+      batch_size = operation.get('batch_size', 10)
+      print '[%s] %s: %.2f docs/s, mean latency per doc %.1f us' % (
+        source, operation.get('name', operation['type']), latencies.count * batch_size / config['phases'][1],
+        latencies.mean() / batch_size)
+  measure_time = config['phases'][1]
+  for name, values in sorted((counters or {}).items()):
+    print '[%s] %s: %.2f docs/s, %.2f MB/s, %d items rejected, %d items failed' % (
+      source, name, values['docs'] / measure_time, values['bytes'] / measure_time / (1024.0 * 1024.0),
+      values['rejected'], values['failed'])
+
+
+def start_sampler(config, start_time=None):
+  if config['node_stats'] == '':
+    return None
+  es = Elasticsearch(hosts=['http://%s:9200' % config['es_server']], timeout=600)
+  sampler = nodestats.NodeStatsSampler(es, config['stats_interval'], nodestats.benchmark_phases(config['phases']),
+                                       start_time)
+  sampler.start()
+  return sampler
+
+
+def stop_sampler(sampler, source, config, throughput):
+  if sampler is not None:
+    sampler.stop()
+    sampler.report(source, config['node_stats'], {'rate': config['rate'], 'throughput': throughput})
+
+
+def save_results(results_dir, label, config, env, throughput, recorder, argv, name=None):
+  # One record per run, so a sweep writes one for every step. A run in which
+  # no request completed (e.g. every thread died on an error) is not saved.
+  if recorder.overall().count == 0:
+    print '[Main Thread] No requests completed, results not saved.'
+    return
+  metrics = {'ops/s': throughput}
+  metrics.update(results.latency_metrics('all', recorder.overall()))
+  for op, latencies in recorder.ops.items():
+    metrics.update(results.latency_metrics(op, latencies))
+  latencies = recorder.to_dict()
+  series = []
+  for index, data in latencies['series']:
+    interval_latencies = histogram.LatencyHistogram.from_dict(data)
+    series.append([index * recorder.interval, interval_latencies.count / recorder.interval,
+                   interval_latencies.percentile(50), interval_latencies.percentile(99)])
+  path = results.save(results_dir, 'esthroughput', name or config['workload']['name'], label, config, env, metrics,
+                      {'argv': argv, 'latencies': latencies, 'series': series})
+  if path is not None:
+    print '[Main Thread] Results written to %s' % path
+
+
+def run_local(config):
+  threads = create_threads(config)
+  sampler = start_sampler(config)
+  throughput, recorder = join_threads(threads)
+  report('Main Thread', throughput, recorder, config, cache_stats=cache_stats(threads),
+         counters=operation_counters(threads))
+  stop_sampler(sampler, 'Main Thread', config, throughput)
+  return throughput, recorder
+
+
+def run_concurrency_sweep(config, levels, percentile, tolerance, min_step, save):
+  # Steps through the concurrency levels after one warmup at the highest of
+  # them, so every step sees the same warm connections and caches. Returns
+  # (concurrency, throughput, latency percentile in us) per step.
+  controller = sweep.Sweep()
+  threads = create_threads(dict(config, num_threads=max(levels)), controller)
+  sampler = start_sampler(config)
+  warmup, max_step = config['phases'][0], config['phases'][1]
+  for thread in threads:
+    thread.start()
+  print '[Main Thread] Warmup phase at concurrency %d...' % max(levels)
+  controller.begin(max(levels), False)
+  time.sleep(warmup)
+  phases = [('warmup', 0.0, warmup)]
+  steps = []
+  flat = 0
+  for level in levels:
+    controller.begin(level, False)
+    time.sleep(config['interval'])
+    generation = controller.begin(level, True)
+    step_start = time.time()
+    duration, steady = controller.measure_step(threads[:level], max_step, config['interval'], tolerance, min_step)
+    controller.begin(level, False)
+    recorder = histogram.LatencyRecorder(config['interval'])
+    counters = {}
+    for thread_recorder, thread_counters in controller.collect(generation):
+      recorder.merge(thread_recorder)
+      workload.merge_counters(counters, thread_counters)
+    if controller.error is not None:
+      print '[Main Thread] A sweep thread failed, stopping the sweep at concurrency %d.' % level
+      controller.finish()
+      for thread in threads:
+        thread.join()
+      if sampler is not None:
+        sampler.stop()
+      error = controller.error
+      raise error[0], error[1], error[2]
+    throughput = recorder.overall().count / duration
+    if sampler is not None:
+      phases.append(('concurrency %d' % level, step_start - sampler.start_time, time.time() - sampler.start_time))
+    step_config = dict(config, num_threads=level, phases=[warmup, duration, 0])
+    report('Concurrency %d' % level, throughput, recorder, step_config, series=False, counters=counters)
+    save(step_config, throughput, recorder, '%s@%d' % (config['workload']['name'], level))
+    latency = recorder.overall().percentile(percentile)
+    print '[Main Thread] Concurrency %d: %.2f ops/s, p%g %.2f ms, measured %.1fs%s' % (
+      level, throughput, percentile, latency / 1000.0, duration, ' (stable)' if steady else '')
+    if steps and sweep.gain(steps[-1][1], throughput) < sweep.KNEE_GAIN:
+      flat += 1
     else:
-      print '[Thread %d] Error: Invalid bench_type %s.' % (self.thread_id, self.bench_type)
-      sys.exit(2)
-
-    writeLock.acquire()
-    with open('thput', 'a') as out:
-      out.write('%d\t%.2f\n' % (self.thread_id, throughput))
-    writeLock.release()
-
-
-def csv2json(csv):
-  json = {}
-  fields = csv.split('|')
-  for i in range(0, len(fields)):
-    json['field%d' % i] = fields[i]
-  return json
-
-
-def load_queries(bench_type, query_file, append_file, record_count):
-  queries = []
-  appends = []
-  print '[Main Thread] Loading queries...'
-  if bench_type == 'search':
-    
-    if query_file == '':
-      print 'Error: Must specify query-file for search benchmark!'
-      sys.exit(2)
-    with open(query_file) as ifp:
-      for line in ifp:
-        field_id, query = line.strip().split('|', 2)
-        qbody = {'query': {'match': {'field%s' % field_id: query}}}
-        queries.append(qbody)
-    queries = random.sample(queries, min(100000, len(queries)))
-    
-  elif bench_type == 'get':
-    
-    queries = [random.randrange(0, record_count) for _ in range(min(100000, record_count))]
-    
-  elif bench_type == 'search-append':
-    
-    search_queries = []
-    if query_file == '':
-      print 'Error: Must specify query-file for search benchmark!'
-      sys.exit(2)
-    with open(query_file) as ifp:
-      for line in ifp:
-        field_id, query = line.strip().split('|', 2)
-        qbody = {'query': {'match': {'field%s' % field_id: query}}}
-        search_queries.append(qbody)
-    search_queries = random.sample(search_queries, min(100000, len(search_queries)))
-    
-    append_queries = []
-    if append_file == '':
-      print 'Error: Must specify append-file for search benchmark!'
-      sys.exit(2)
-    with open(append_file) as ifp:
-      for line in ifp:
-        doc = csv2json(line.rstrip())
-        append_queries.append(doc)
-    append_queries = random.sample(append_queries, min(100000, len(append_queries)))
-    
-    aid = 0
-    sid = 0
-    query_count = 100000
-    for i in range(0, query_count):
-      if i % 20 == 0:
-        queries.append(append_queries[aid % len(append_queries)])
-        aid += 1
-      else:
-        queries.append(search_queries[sid % len(search_queries)])
-        sid += 1
-        
-  elif bench_type == 'get-append':
-    
-    get_queries = [random.randrange(0, record_count) for _ in range(min(100000, record_count))]
-    
-    append_queries = []
-    if append_file == '':
-      print 'Error: Must specify append-file for search benchmark!'
-      sys.exit(2)
-    with open(append_file) as ifp:
-      for line in ifp:
-        doc = csv2json(line.rstrip())
-        append_queries.append(doc)
-    append_queries = random.sample(append_queries, min(100000, len(append_queries)))
-    
-    aid = 0
-    gid = 0
-    query_count = 100000
-    for i in range(0, query_count):
-      if i % 20 == 0:
-        queries.append(append_queries[aid % len(append_queries)])
-        aid += 1
-      else:
-        queries.append(get_queries[gid % len(get_queries)])
-        gid += 1
-    
-  elif bench_type == 'get-search':
-    
-    get_queries = random.sample(range(0, record_count), min(100000, record_count))
-    
-    search_queries = []
-    if query_file == '':
-      print 'Error: Must specify query-file for search benchmark!'
-      sys.exit(2)
-    with open(query_file) as ifp:
-      for line in ifp:
-        field_id, query = line.strip().split('|', 2)
-        qbody = {'query': {'match': {'field%s' % field_id: query}}}
-        search_queries.append(qbody)
-    search_queries = random.sample(search_queries, min(100000, len(search_queries)))
-
-    query_count = max(len(get_queries), len(search_queries)) * 2
-    for i in range(0, query_count):
-      if i % 2 == 0:
-        queries.append(get_queries[(i / 2) % len(get_queries)])
-      else:
-        queries.append(search_queries[(i / 2) % len(search_queries)])
+      flat = 0
+    steps.append((level, throughput, latency))
+    if flat >= sweep.KNEE_STOP and sweep.find_knee(steps) is not None and level != levels[-1]:
+      print '[Main Thread] No throughput gain for %d steps, skipping the remaining levels.' % flat
+      break
+  controller.finish()
+  for thread in threads:
+    thread.join()
+  if sampler is not None:
+    sampler.phases = phases
+  stop_sampler(sampler, 'Main Thread', config, max(step[1] for step in steps))
+  return steps
+
+
+def report_curve(steps, percentile):
+  knee = sweep.find_knee(steps)
+  print '[Main Thread] %11s %14s %14s' % ('concurrency', 'ops/s', 'p%g (ms)' % percentile)
+  for i, (level, throughput, latency) in enumerate(steps):
+    print '[Main Thread] %11d %14.2f %14.2f%s' % (level, throughput, latency / 1000.0, '  <- knee' if i == knee else '')
+  if knee is None:
+    print '[Main Thread] No knee found: throughput kept rising up to concurrency %d.' % steps[-1][0]
   else:
-    print 'Error: Invalid benchtype %s' % bench_type
-
-  return queries
+    print '[Main Thread] Knee at concurrency %d: %.2f ops/s, p%g %.2f ms.' % (
+      steps[knee][0], steps[knee][1], percentile, steps[knee][2] / 1000.0)
+
+
+def run_worker(address):
+  coordinator = distributed.connect(address)
+  while True:
+    message = coordinator.recv()
+    if message['type'] == 'exit':
+      break
+    threads = create_threads(message['config'])
+    coordinator.send({'type': 'ready'})
+    message = coordinator.recv()
+    throughput, recorder = join_threads(threads, time.time() + message['delay'])
+    coordinator.send({'type': 'result', 'throughput': throughput, 'latencies': recorder.to_dict(),
+                      'cache': cache_stats(threads), 'counters': operation_counters(threads)})
+  coordinator.close()
+
+
+def run_distributed(coordinator, config, num_workers):
+  # Every worker gets the full per-process thread count and an equal share of
+  # the target rate.
+  worker_config = dict(config)
+  worker_config['rate'] = config['rate'] / num_workers
+  # The sampler's phases start with the workers', which is only known once
+  # they have all loaded their corpora and are sent "start".
+  samplers = []
+  worker_results = coordinator.run(worker_config, start_delay,
+                                   lambda start_time: samplers.append(start_sampler(config, start_time)))
+  sampler = samplers[0] if samplers else None
+  throughput = 0.0
+  recorder = histogram.LatencyRecorder(config['interval'])
+  worker_cache_stats = []
+  counters = {}
+  for result in worker_results:
+    worker_recorder = histogram.LatencyRecorder.from_dict(result['latencies'])
+    report('Worker %s' % result['worker'], result['throughput'], worker_recorder, worker_config, series=False,
+           cache_stats=result['cache'], counters=result['counters'])
+    workload.merge_counters(counters, result['counters'])
+    throughput += result['throughput']
+    recorder.merge(worker_recorder)
+    if result['cache'] is not None:
+      worker_cache_stats.append(result['cache'])
+  merged_cache_stats = result_cache.merge_stats(worker_cache_stats) if worker_cache_stats else None
+  report('Coordinator', throughput, recorder, config, cache_stats=merged_cache_stats, counters=counters)
+  stop_sampler(sampler, 'Coordinator', config, throughput)
+  return throughput, recorder
 
 
 def main(argv):
@@ -464,10 +508,50 @@ def main(argv):
   doc_type = 'data'
   bench_type = 'search'
   num_threads = 1
-  help_msg = 'esthroughput.py -e <es-server> -q <queries> -a <appends> -i <index> -t <doc-type> -b <bench-type> -n <num-threads>'
+  typed = False
+  rate = 0.0
+  sweep_step = 0.0
+  sweep_limit = 0.0
+  slo = 0.0
+  slo_percentile = 99.0
+  phases = [60, 120, 60]
+  engine = 'threads'
+  num_processes = 1
+  listen_port = 0
+  num_remote = 0
+  coordinator_address = ''
+  interval = 1.0
+  workload_file = ''
+  key_params = {}
+  raw = False
+  batch_sizes = []
+  coalesce = 0.0
+  cache_params = {}
+  node_stats = ''
+  stats_interval = 5.0
+  results_dir = results.RESULTS_DIR
+  label = ''
+  levels = []
+  stability = sweep.STABILITY
+  min_step = sweep.MIN_STEP
+  help_msg = ('esthroughput.py -e <es-server> -q <queries> -a <appends> -i <index> -t <doc-type> -b <bench-type> '
+              '-n <num-threads> -y -r <rate> -s <sweep-step> -m <sweep-max-rate> -l <slo-ms> -p <slo-percentile> '
+              '-W <warmup-secs> -M <measure-secs> -C <cooldown-secs> -g <threads|async> -N <processes> '
+              '-L <listen-port> -R <remote-workers> -c <coordinator-host:port> -I <report-interval-secs> '
+              '-w <workload-file> -d <uniform|zipfian|hotspot|latest> -z <zipf-exponent> '
+              '-H <hot-requests-pct,hot-keys-pct> -x -B <batch-size[,batch-size...]> -o <coalesce-window-ms> '
+              '-K <lru|ttl> -Z <cache-mb> -T <cache-ttl-secs> -S <node-stats-file> -V <stats-interval-secs> '
+              '-O <results-dir> --label <label> -u <threads,threads...|min:max> --stability <pct> '
+              '--min-step <secs>')
   try:
-    opts, args = getopt.getopt(argv, 'he:q:a:i:t:b:n:',
-                               ['es-server', 'queries=', 'appends=', 'index=', 'type=', 'benchtype=', 'numthreads='])
+    opts, args = getopt.getopt(argv, 'he:q:a:i:t:b:n:yr:s:m:l:p:W:M:C:g:N:L:R:c:I:w:d:z:H:xB:o:K:Z:T:S:V:O:u:',
+                               ['es-server', 'queries=', 'appends=', 'index=', 'type=', 'benchtype=', 'numthreads=',
+                                'typed', 'rate=', 'sweep=', 'sweep-max=', 'slo=', 'slo-percentile=', 'warmup=',
+                                'measure=', 'cooldown=', 'engine=', 'processes=', 'listen=', 'remote-workers=',
+                                'coordinator=', 'interval=', 'workload=', 'distribution=', 'zipf-exponent=',
+                                'hotspot=', 'raw', 'batch-size=', 'coalesce=', 'cache=', 'cache-mb=',
+                                'cache-ttl=', 'node-stats=', 'stats-interval=', 'results-dir=', 'label=',
+                                'concurrency=', 'stability=', 'min-step='])
   except getopt.GetoptError:
     print help_msg
     sys.exit(2)
@@ -489,26 +573,226 @@ def main(argv):
       bench_type = arg
     elif opt in ('-n', '--numthreads'):
       num_threads = int(arg)
+    elif opt in ('-y', '--typed'):
+      typed = True
+    elif opt in ('-r', '--rate'):
+      rate = float(arg)
+    elif opt in ('-s', '--sweep'):
+      sweep_step = float(arg)
+    elif opt in ('-m', '--sweep-max'):
+      sweep_limit = float(arg)
+    elif opt in ('-l', '--slo'):
+      slo = float(arg)
+    elif opt in ('-p', '--slo-percentile'):
+      slo_percentile = float(arg)
+    elif opt in ('-W', '--warmup'):
+      phases[0] = float(arg)
+    elif opt in ('-M', '--measure'):
+      phases[1] = float(arg)
+    elif opt in ('-C', '--cooldown'):
+      phases[2] = float(arg)
+    elif opt in ('-g', '--engine'):
+      engine = arg
+    elif opt in ('-N', '--processes'):
+      num_processes = int(arg)
+    elif opt in ('-L', '--listen'):
+      listen_port = int(arg)
+    elif opt in ('-R', '--remote-workers'):
+      num_remote = int(arg)
+    elif opt in ('-c', '--coordinator'):
+      coordinator_address = arg
+    elif opt in ('-I', '--interval'):
+      interval = float(arg)
+    elif opt in ('-w', '--workload'):
+      workload_file = arg
+    elif opt in ('-d', '--distribution'):
+      key_params['distribution'] = arg
+    elif opt in ('-z', '--zipf-exponent'):
+      key_params['exponent'] = float(arg)
+    elif opt in ('-H', '--hotspot'):
+      hot_requests, hot_keys = arg.split(',')
+      key_params['hot_requests'] = float(hot_requests) / 100.0
+      key_params['hot_keys'] = float(hot_keys) / 100.0
+    elif opt in ('-x', '--raw'):
+      raw = True
+    elif opt in ('-B', '--batch-size'):
+      batch_sizes = [int(batch_size) for batch_size in arg.split(',')]
+    elif opt in ('-o', '--coalesce'):
+      coalesce = float(arg) / 1000.0
+    elif opt in ('-K', '--cache'):
+      cache_params['type'] = arg
+    elif opt in ('-Z', '--cache-mb'):
+      cache_params['max_bytes'] = int(float(arg) * 1024 * 1024)
+    elif opt in ('-T', '--cache-ttl'):
+      cache_params['ttl'] = float(arg)
+    elif opt in ('-S', '--node-stats'):
+      node_stats = arg
+    elif opt in ('-V', '--stats-interval'):
+      stats_interval = float(arg)
+    elif opt in ('-O', '--results-dir'):
+      results_dir = arg
+    elif opt == '--label':
+      label = arg
+    elif opt in ('-u', '--concurrency'):
+      try:
+        levels = sweep.parse_levels(arg)
+      except ValueError as e:
+        print 'Error: %s' % e
+        sys.exit(2)
+    elif opt == '--stability':
+      stability = float(arg)
+    elif opt == '--min-step':
+      min_step = float(arg)
+  if engine not in ('threads', 'async'):
+    print 'Error: Invalid engine %s' % engine
+    sys.exit(2)
+  if sweep_step > 0 and (rate <= 0 or slo <= 0):
+    print 'Error: Must specify starting rate and latency SLO for a rate sweep!'
+    sys.exit(2)
+  if sweep_step > 0 and len(batch_sizes) > 1:
+    print 'Error: Cannot sweep rates and batch sizes in the same run!'
+    sys.exit(2)
+  if levels and (rate > 0 or sweep_step > 0 or len(batch_sizes) > 1):
+    print 'Error: A concurrency sweep is closed-loop and cannot be combined with a rate or batch size sweep!'
+    sys.exit(2)
+  if levels and (num_processes > 1 or num_remote > 0):
+    print 'Error: A concurrency sweep runs in a single process!'
+    sys.exit(2)
+  if num_remote > 0 and listen_port == 0:
+    print 'Error: Must specify listen port for remote workers!'
+    sys.exit(2)
+
+  if coordinator_address != '':
+    run_worker(coordinator_address)
+    return
+
+  try:
+    if workload_file != '':
+      spec = workload.read_workload(workload_file)
+      # Key distribution flags apply to the gets that do not set their own.
+      for operation in spec.get('operations') or []:
+        if operation.get('type') == 'get' and 'distribution' not in operation:
+          operation.update(key_params)
+    else:
+      spec = workload.bench_type_workload(bench_type, query_file, append_file, key_params)
+    if cache_params:
+      spec.setdefault('cache', {})
+      spec['cache'].update(cache_params)
+    for operation in spec.get('operations') or []:
+      if raw:
+        operation.setdefault('raw', True)
+      if coalesce > 0 and operation.get('type') == 'get':
+        operation.setdefault('coalesce', coalesce)
+    workload.validate(spec)
+  except (IOError, ValueError) as e:
+    print 'Error: %s' % e
+    sys.exit(2)
 
   es = Elasticsearch(hosts=['http://%s:9200' % es_server], timeout=600)
   count = es.count(index=index)['count']
+  env = results.environment(es, index)
   del es
 
-  threads = []
-  print '[Main Thread] Initializing %d threads...' % num_threads
-  for i in range(0, num_threads):
-    queries = load_queries(bench_type=bench_type, query_file=query_file, append_file=append_file, record_count=count)
-    thread = BenchmarkThread(thread_id=i, bench_type=bench_type, es_server=es_server, index=index, doc_type=doc_type,
-                             queries=queries, record_count=count)
-    threads.append(thread)
+  config = {
+    'workload': spec,
+    'es_server': es_server,
+    'index': index,
+    'doc_type': doc_type,
+    'record_count': count,
+    'num_threads': num_threads,
+    'typed': typed,
+    'rate': rate,
+    'phases': phases,
+    'engine': engine,
+    'interval': interval,
+    'node_stats': node_stats,
+    'stats_interval': stats_interval,
+  }
+
+  calibrate()
+
+  coordinator = None
+  if num_processes > 1 or num_remote > 0:
+    coordinator = distributed.Coordinator(listen_port, num_processes + num_remote)
+    print '[Coordinator] Listening on port %d for %d local and %d remote workers...' % (coordinator.port,
+                                                                                       num_processes, num_remote)
+    for _ in range(0, num_processes):
+      process = multiprocessing.Process(target=run_worker, args=('127.0.0.1:%d' % coordinator.port,))
+      process.daemon = True
+      process.start()
+    coordinator.accept()
+
+  def run(config, name=None):
+    # The steps of a rate or batch size sweep are saved under their own
+    # names, so that comparisons do not take them for repetitions.
+    if coordinator is not None:
+      throughput, recorder = run_distributed(coordinator, config, num_processes + num_remote)
+    else:
+      throughput, recorder = run_local(config)
+    save_results(results_dir, label, dict(config, processes=num_processes + num_remote), env, throughput,
+                 recorder, argv, name)
+    return throughput, recorder
 
-  print '[Main Thread] Starting threads...'
-  for thread in threads:
-    thread.start()
+  def set_batch_size(batch_size):
+    for operation in spec['operations']:
+      if operation['type'] in ('mget', 'bulk') or operation.get('coalesce'):
+        operation['batch_size'] = batch_size
 
-  print '[Main Thread] Waiting for threads to join...'
-  for thread in threads:
-    thread.join()
+  try:
+    if len(batch_sizes) == 1:
+      set_batch_size(batch_sizes[0])
+    elif len(batch_sizes) > 1:
+      # Run once per batch size, then compare documents/sec across sizes.
+      batch_results = []
+      for batch_size in batch_sizes:
+        set_batch_size(batch_size)
+        print '[Main Thread] Batch size %d...' % batch_size
+        throughput, recorder = run(dict(config, batch_size=batch_size), '%s@batch%d' % (spec['name'], batch_size))
+        batch_results.append((batch_size, throughput, recorder.overall()))
+      for batch_size, throughput, latencies in batch_results:
+        print '[Main Thread] Batch size %d: %.2f requests/s, %.2f docs/s, latency per batch (us) %s' % (
+          batch_size, throughput, throughput * batch_size, histogram.summary(latencies))
+      return
+
+    if levels:
+      def save(step_config, throughput, recorder, name):
+        save_results(results_dir, label, dict(step_config, processes=1), env, throughput, recorder, argv, name)
+      report_curve(run_concurrency_sweep(config, levels, slo_percentile, stability, min_step, save), slo_percentile)
+      return
+
+    if sweep_step <= 0:
+      run(config)
+      return
+
+    # Step the target rate up until the latency percentile breaks the SLO, or
+    # up to the maximum rate or max_sweep_steps steps.
+    max_rate = None
+    for _ in range(0, max_sweep_steps):
+      throughput, recorder = run(config, '%s@%g/s' % (spec['name'], config['rate']))
+      if recorder.overall().count == 0:
+        # Without a single completed request the SLO could never be broken.
+        print 'Error: No requests completed at %.2f ops/s, stopping the sweep!' % config['rate']
+        sys.exit(1)
+      latency = recorder.overall().percentile(slo_percentile) / 1000.0
+      print '[Main Thread] Rate %.2f ops/s: throughput %.2f ops/s, p%g %.2f ms' % (config['rate'], throughput,
+                                                                                   slo_percentile, latency)
+      if latency > slo:
+        break
+      max_rate = config['rate']
+      if sweep_limit > 0 and config['rate'] + sweep_step > sweep_limit:
+        print '[Main Thread] Reached the maximum sweep rate of %.2f ops/s.' % sweep_limit
+        break
+      config['rate'] += sweep_step
+    else:
+      print '[Main Thread] Stopped after %d steps without breaking the SLO.' % max_sweep_steps
+
+    if max_rate is None:
+      print '[Main Thread] SLO of %.2f ms at p%g broken at the starting rate.' % (slo, slo_percentile)
+    else:
+      print '[Main Thread] Max rate within SLO of %.2f ms at p%g: %.2f ops/s' % (slo, slo_percentile, max_rate)
+  finally:
+    if coordinator is not None:
+      coordinator.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+from array import array
+
+# Latencies are recorded in microseconds into log-linear buckets, in the style
+# of HdrHistogram: every power-of-two range is split into SUB_BUCKETS / 2
+# linear sub-buckets, so recorded values keep a relative error below
+# 2 / SUB_BUCKETS while memory stays fixed regardless of the number of samples.
+PRECISION_BITS = 8
+SUB_BUCKETS = 1 << PRECISION_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+MAX_VALUE = (1 << 36) - 1
+BUCKETS = MAX_VALUE.bit_length() - PRECISION_BITS + 1
+
+
+def bucket_index(value):
+  shift = max(0, value.bit_length() - PRECISION_BITS)
+  return shift * HALF_SUB_BUCKETS + (value >> shift)
+
+
+def bucket_value(index):
+  # Highest value that maps to the bucket, so percentiles are never reported
+  # lower than what was recorded.
+  shift = max(0, (index >> (PRECISION_BITS - 1)) - 1)
+  sub_bucket = index - shift * HALF_SUB_BUCKETS
+  return ((sub_bucket + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+  def __init__(self):
+    self.counts = array('l', [0]) * (BUCKETS * HALF_SUB_BUCKETS + HALF_SUB_BUCKETS)
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = 0
+
+  def record(self, value):
+    value = min(max(int(value), 0), MAX_VALUE)
+    self.counts[bucket_index(value)] += 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if value > self.max:
+      self.max = value
+
+  def reset(self):
+    for i in range(0, len(self.counts)):
+      self.counts[i] = 0
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = 0
+
+  def merge(self, other):
+    for i in range(0, len(other.counts)):
+      if other.counts[i]:
+        self.counts[i] += other.counts[i]
+    self.count += other.count
+    self.total += other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    self.max = max(self.max, other.max)
+
+  def mean(self):
+    return float(self.total) / self.count if self.count else 0.0
+
+  def percentile(self, p):
+    if self.count == 0:
+      return 0
+    rank = max(1, int(round(p / 100.0 * self.count)))
+    seen = 0
+    for i in range(0, len(self.counts)):
+      seen += self.counts[i]
+      if seen >= rank:
+        return min(bucket_value(i), self.max)
+    return self.max
+
+  def to_dict(self):
+    counts = [[i, self.counts[i]] for i in range(0, len(self.counts)) if self.counts[i]]
+    return {'counts': counts, 'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+
+  @staticmethod
+  def from_dict(data):
+    latencies = LatencyHistogram()
+    for i, count in data['counts']:
+      latencies.counts[i] = count
+    latencies.count = data['count']
+    latencies.total = data['total']
+    latencies.min = data['min']
+    latencies.max = data['max']
+    return latencies
+
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def summary(latencies):
+  values = ' '.join('p%g %d' % (p, latencies.percentile(p)) for p in PERCENTILES)
+  return '%s max %d' % (values, latencies.max)
+
+
+class LatencyRecorder(object):
+  # Keeps one histogram per operation type over a whole phase, and one per
+  # interval of the phase for a time series of throughput and latency. Only
+  # the current interval is held as a full histogram; finished intervals are
+  # kept in the sparse to_dict() form to bound memory.
+  def __init__(self, interval=1.0):
+    self.interval = interval
+    self.ops = {}
+    self.series = {}
+    self.current = LatencyHistogram()
+    self.current_index = 0
+
+  def record(self, op, latency, elapsed):
+    latencies = self.ops.get(op)
+    if latencies is None:
+      latencies = self.ops[op] = LatencyHistogram()
+    latencies.record(latency)
+    index = int(elapsed / self.interval)
+    if index != self.current_index:
+      self.flush()
+      self.current_index = index
+    self.current.record(latency)
+
+  def flush(self):
+    if self.current.count:
+      self.series[self.current_index] = self.current.to_dict()
+      self.current.reset()
+
+  def overall(self):
+    latencies = LatencyHistogram()
+    for op_latencies in self.ops.values():
+      latencies.merge(op_latencies)
+    return latencies
+
+  def merge(self, other):
+    other.flush()
+    for op, latencies in other.ops.items():
+      if op not in self.ops:
+        self.ops[op] = LatencyHistogram()
+      self.ops[op].merge(latencies)
+    for index, data in other.series.items():
+      if index in self.series:
+        merged = LatencyHistogram.from_dict(self.series[index])
+        merged.merge(LatencyHistogram.from_dict(data))
+        data = merged.to_dict()
+      self.series[index] = data
+
+  def to_dict(self):
+    self.flush()
+    return {
+      'interval': self.interval,
+      'ops': dict((op, latencies.to_dict()) for op, latencies in self.ops.items()),
+      'series': [[index, data] for index, data in sorted(self.series.items())],
+    }
+
+  @staticmethod
+  def from_dict(data):
+    recorder = LatencyRecorder(data['interval'])
+    for op, latencies in data['ops'].items():
+      recorder.ops[op] = LatencyHistogram.from_dict(latencies)
+    for index, latencies in data['series']:
+      recorder.series[index] = latencies
+    return recorder
+
+  def report(self, source, duration, series=True):
+    for op in sorted(self.ops):
+      latencies = self.ops[op]
+      print '[%s] %s: %d ops, latency (us) %s' % (source, op, latencies.count, summary(latencies))
+    if not series:
+      return
+    self.flush()
+    for index in sorted(self.series):
+      latencies = LatencyHistogram.from_dict(self.series[index])
+      start = index * self.interval
+      length = min(self.interval, duration - start)
+      throughput = latencies.count / length if length > 0 else 0.0
+      print '[%s] %6.1fs: %.2f ops/s, latency (us) %s' % (source, start, throughput, summary(latencies))
@@ -0,0 +1,151 @@
+import math
+import random
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Distributions of the document ids requested by get operations:
+#   uniform  every id is equally likely
+#   zipfian  the id of rank k is requested with probability proportional to
+#            1 / k^exponent; ranks are scattered over the id space so that hot
+#            documents are not all neighbours in the same segments
+#   hotspot  a fraction hot_requests of the requests go to a fraction hot_keys
+#            of the ids, the rest are spread uniformly over the other ids
+#   latest   zipfian over the distance from the most recently written id, so
+#            documents appended during the run become the hottest
+# With numpy installed, samples are drawn in vectorized batches.
+DISTRIBUTIONS = ('uniform', 'zipfian', 'hotspot', 'latest')
+SCRAMBLE_MULTIPLIER = 2654435761
+
+
+def helper1(x):
+  # log(1 + x) / x, accurate near 0.
+  if abs(x) > 1e-8:
+    return math.log1p(x) / x
+  return 1.0 - x / 2.0 + x * x / 3.0
+
+
+def helper2(x):
+  # (exp(x) - 1) / x, accurate near 0.
+  if abs(x) > 1e-8:
+    return math.expm1(x) / x
+  return 1.0 + x / 2.0 + x * x / 6.0
+
+
+class ZipfSampler(object):
+  # Rejection-inversion sampling (Hormann and Derflinger, 1996) of ranks
+  # 1..n: constant expected time per sample with no table over the n ranks,
+  # so setup is as cheap for 100M records as for 100.
+  def __init__(self, n, exponent):
+    if n < 1:
+      raise ValueError('Cannot sample keys from an empty index')
+    if exponent <= 0:
+      raise ValueError('Zipfian exponent must be positive')
+    self.n = n
+    self.exponent = exponent
+    self.h_integral_x1 = self.h_integral(1.5) - 1.0
+    self.h_integral_n = self.h_integral(n + 0.5)
+    self.s = 2.0 - self.h_integral_inverse(self.h_integral(2.5) - self.h(2.0))
+
+  def h(self, x):
+    return math.exp(-self.exponent * math.log(x))
+
+  def h_integral(self, x):
+    log_x = math.log(x)
+    return helper2((1.0 - self.exponent) * log_x) * log_x
+
+  def h_integral_inverse(self, x):
+    t = max(x * (1.0 - self.exponent), -1.0)
+    return math.exp(helper1(t) * x)
+
+  def sample(self, rng=random):
+    while True:
+      u = self.h_integral_n + rng.random() * (self.h_integral_x1 - self.h_integral_n)
+      x = self.h_integral_inverse(u)
+      k = min(max(int(x + 0.5), 1), self.n)
+      if k - x <= self.s or u >= self.h_integral(k + 0.5) - self.h(k):
+        return k
+
+  def sample_array(self, count, rng):
+    # numpy version of sample(): draw a batch, keep the accepted ranks and
+    # redraw for the rejected ones.
+    one_minus_s = 1.0 - self.exponent
+    ranks = numpy.empty(0, dtype=numpy.int64)
+    while len(ranks) < count:
+      need = count - len(ranks)
+      u = self.h_integral_n + rng.random_sample(need) * (self.h_integral_x1 - self.h_integral_n)
+      t = numpy.maximum(u * one_minus_s, -1.0)
+      small = numpy.abs(t) <= 1e-8
+      safe_t = numpy.where(small, 1.0, t)
+      x = numpy.exp(numpy.where(small, 1.0 - t / 2.0, numpy.log1p(safe_t) / safe_t) * u)
+      k = numpy.clip((x + 0.5).astype(numpy.int64), 1, self.n)
+      log_k = numpy.log(k + 0.5)
+      y = one_minus_s * log_k
+      small = numpy.abs(y) <= 1e-8
+      safe_y = numpy.where(small, 1.0, y)
+      h_integral_k = numpy.where(small, 1.0 + y / 2.0, numpy.expm1(safe_y) / safe_y) * log_k
+      h_k = numpy.exp(-self.exponent * numpy.log(k))
+      accepted = (k - x <= self.s) | (u >= h_integral_k - h_k)
+      ranks = numpy.concatenate((ranks, k[accepted]))
+    return ranks
+
+
+def scramble_multiplier(n):
+  multiplier = SCRAMBLE_MULTIPLIER % n or 1
+  while gcd(multiplier, n) != 1:
+    multiplier += 1
+  return multiplier
+
+
+def gcd(a, b):
+  while b:
+    a, b = b, a % b
+  return a
+
+
+def sample_keys(distribution, count, record_count, exponent=0.99, hot_requests=0.8, hot_keys=0.2, rng=random):
+  # Returns count ids in [0, record_count). For 'latest' the values are
+  # distances back from the most recently written id instead.
+  if distribution not in DISTRIBUTIONS:
+    raise ValueError('Invalid key distribution %s' % distribution)
+  if record_count < 1:
+    raise ValueError('Cannot sample keys from an empty index')
+  if distribution == 'hotspot' and not (0.0 < hot_keys < 1.0 and 0.0 <= hot_requests <= 1.0):
+    raise ValueError('Hotspot fractions must be between 0 and 1')
+
+  if numpy is not None:
+    np_rng = numpy.random.RandomState(rng.getrandbits(32))
+    if distribution == 'uniform':
+      keys = np_rng.randint(0, record_count, count)
+    elif distribution == 'hotspot':
+      hot_count = max(1, int(record_count * hot_keys))
+      hot = np_rng.random_sample(count) < hot_requests
+      keys = numpy.where(hot, np_rng.randint(0, hot_count, count),
+                         hot_count + np_rng.randint(0, max(1, record_count - hot_count), count))
+      keys = numpy.minimum(keys, record_count - 1)
+    else:
+      keys = ZipfSampler(record_count, exponent).sample_array(count, np_rng) - 1
+    if distribution in ('zipfian', 'hotspot'):
+      keys = (keys * scramble_multiplier(record_count)) % record_count
+    return keys.tolist()
+
+  if distribution == 'uniform':
+    return [rng.randrange(0, record_count) for _ in range(count)]
+  if distribution == 'hotspot':
+    hot_count = max(1, int(record_count * hot_keys))
+    cold_count = max(1, record_count - hot_count)
+    keys = []
+    for _ in range(count):
+      if rng.random() < hot_requests:
+        keys.append(rng.randrange(0, hot_count))
+      else:
+        keys.append(min(hot_count + rng.randrange(0, cold_count), record_count - 1))
+  else:
+    sampler = ZipfSampler(record_count, exponent)
+    keys = [sampler.sample(rng) - 1 for _ in range(count)]
+  if distribution in ('zipfian', 'hotspot'):
+    multiplier = scramble_multiplier(record_count)
+    keys = [(key * multiplier) % record_count for key in keys]
+  return keys
@@ -0,0 +1,174 @@
+import sys
+import json
+import time
+import threading
+from elasticsearch import TransportError, ConnectionError
+
+# Sections of _nodes/stats that are sampled, summed over all nodes. Values
+# are flattened into dotted keys, e.g. thread_pool.search.rejected.
+SECTIONS = [
+  ('jvm', 'gc'),
+  ('jvm', 'mem'),
+  ('thread_pool',),
+  ('indices', 'query_cache'),
+  ('indices', 'request_cache'),
+  ('indices', 'fielddata'),
+  ('indices', 'segments'),
+  ('indices', 'merges'),
+]
+
+# Keys that are point-in-time values rather than running totals. Per phase,
+# gauges are reported as their maximum, counters as their increase.
+GAUGES = ('queue', 'active', 'threads', 'largest', 'current', 'current_docs', 'current_size_in_bytes', 'cache_size')
+GAUGE_PREFIXES = ('jvm.mem.', 'indices.segments.')
+
+
+def is_gauge(key):
+  return key.rsplit('.', 1)[-1] in GAUGES or key.startswith(GAUGE_PREFIXES) or 'memory' in key
+
+
+def collect(value, prefix, totals):
+  if isinstance(value, dict):
+    for key, child in value.items():
+      collect(child, '%s.%s' % (prefix, key), totals)
+  elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+    totals[prefix] = totals.get(prefix, 0) + value
+
+
+def flatten(stats):
+  totals = {}
+  for node in stats.get('nodes', {}).values():
+    for section in SECTIONS:
+      value = node
+      for key in section:
+        value = value.get(key, {}) if isinstance(value, dict) else {}
+      collect(value, '.'.join(section), totals)
+  return totals
+
+
+def phase_stats(samples, start, end):
+  # Counter increases between the first sample at or after start and the
+  # first sample at or after end, and gauge maximums over the samples in
+  # between. The sampler takes a sample at every phase boundary.
+  first = None
+  last = None
+  for i in range(0, len(samples)):
+    if first is None and samples[i][0] >= start:
+      first = i
+    if samples[i][0] >= end:
+      last = i
+      break
+  if first is None:
+    return None
+  if last is None:
+    last = len(samples) - 1
+  counters = {}
+  gauges = {}
+  for key, value in samples[last][1].items():
+    if is_gauge(key):
+      gauges[key] = max(sample[1].get(key, 0) for sample in samples[first:last + 1])
+    else:
+      counters[key] = value - samples[first][1].get(key, 0)
+  return {'start': samples[first][0], 'end': samples[last][0], 'counters': counters, 'gauges': gauges}
+
+
+def sum_matching(values, prefix, suffix):
+  return sum(value for key, value in values.items() if key.startswith(prefix) and key.endswith(suffix))
+
+
+def summary(stats):
+  counters = stats['counters']
+  gauges = stats['gauges']
+  rejected = ', '.join('%s %d' % (key.split('.')[1], value) for key, value in sorted(counters.items())
+                       if key.startswith('thread_pool.') and key.endswith('.rejected') and value)
+  return ('gc %d collections %d ms, rejected %d%s, search queue max %d, query cache evictions %d, '
+          'request cache evictions %d, fielddata evictions %d, merges %d (%d ms), segments max %d' % (
+            sum_matching(counters, 'jvm.gc.', '.collection_count'),
+            sum_matching(counters, 'jvm.gc.', '.collection_time_in_millis'),
+            sum_matching(counters, 'thread_pool.', '.rejected'), ' (%s)' % rejected if rejected else '',
+            gauges.get('thread_pool.search.queue', 0), counters.get('indices.query_cache.evictions', 0),
+            counters.get('indices.request_cache.evictions', 0), counters.get('indices.fielddata.evictions', 0),
+            counters.get('indices.merges.total', 0), counters.get('indices.merges.total_time_in_millis', 0),
+            gauges.get('indices.segments.count', 0)))
+
+
+class NodeStatsSampler(threading.Thread):
+  # Polls _nodes/stats every interval seconds, and at every phase boundary,
+  # from when it is started until stop() is called. Phases are (name, start,
+  # end) tuples in seconds from start_time; without phases the whole sampled
+  # period is one 'run' phase.
+  def __init__(self, es, interval=5.0, phases=None, start_time=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.es = es
+    self.interval = interval
+    self.phases = phases
+    self.start_time = start_time
+    self.samples = []
+    self.errors = 0
+    self.stopped = threading.Event()
+
+  def sample(self):
+    try:
+      stats = self.es.nodes.stats(metric='jvm,thread_pool,indices')
+    except (TransportError, ConnectionError) as e:
+      if self.errors == 0:
+        print '[Node Stats] Error: %s' % e
+      self.errors += 1
+      return
+    self.samples.append((time.time(), flatten(stats)))
+
+  def run(self):
+    if self.start_time is None:
+      self.start_time = time.time()
+    boundaries = []
+    for _, start, end in self.phases or []:
+      boundaries.extend([self.start_time + start, self.start_time + end])
+    boundaries = sorted(set(boundaries))
+    self.sample()
+    next_sample = time.time() + self.interval
+    while True:
+      now = time.time()
+      upcoming = [boundary for boundary in boundaries if boundary > now]
+      wake = min([next_sample] + upcoming[:1])
+      if self.stopped.wait(max(0.0, wake - now)):
+        break
+      self.sample()
+      if wake == next_sample:
+        next_sample += self.interval
+    self.sample()
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+
+  def results(self):
+    phases = self.phases or [('run', 0.0, float('inf'))]
+    results = {}
+    for name, start, end in phases:
+      stats = phase_stats(self.samples, self.start_time + start, self.start_time + end)
+      if stats is not None:
+        stats['start'] -= self.start_time
+        stats['end'] -= self.start_time
+        results[name] = stats
+    return results
+
+  def report(self, source, path, extra=None, out=sys.stdout):
+    # Prints a summary line per phase and appends the full per-phase deltas
+    # and the samples to path as one JSON line.
+    results = self.results()
+    names = [phase[0] for phase in self.phases] if self.phases else ['run']
+    for name in names:
+      if name in results:
+        print >> out, '[%s] Node stats %s: %s' % (source, name, summary(results[name]))
+    record = dict(extra or {})
+    record['phases'] = results
+    record['samples'] = [[sample_time - self.start_time, values] for sample_time, values in self.samples]
+    with open(path, 'a') as ofp:
+      ofp.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def benchmark_phases(phases):
+  warmup, measure, cooldown = phases
+  return [('warmup', 0.0, warmup), ('measure', warmup, warmup + measure),
+          ('cooldown', warmup + measure, warmup + measure + cooldown)]
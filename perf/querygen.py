@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import getopt
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'load'))
+import lineitem
+
+# Query templates, filled in with values sampled from the columns of a
+# lineitem data file. A string that is exactly "{column}" is replaced by a
+# value of that column (converted to the column's type, so numbers stay
+# numbers), the same value everywhere it appears in one query. "{column:lo}"
+# and "{column:hi}" are the ends of a range between two sampled values, and
+# "{column:word}" is one word of a sampled value. Columns are named as in
+# lineitem.COLUMNS and stored as field<i>.
+#
+# The range, sort and aggregation templates expect the typed mapping
+# (esload.py --typed); with every field a string they fail or compare text.
+TEMPLATES = {
+  'match': {'query': {'match': {'field15': '{comment:word}'}}},
+  'term': {'query': {'term': {'field14': '{shipmode}'}}},
+  'range': {'query': {'range': {'field10': {'gte': '{shipdate:lo}', 'lte': '{shipdate:hi}'}}}},
+  'bool': {'query': {'bool': {
+    'must': [{'term': {'field14': '{shipmode}'}}],
+    'filter': [{'range': {'field4': {'gte': '{quantity:lo}', 'lte': '{quantity:hi}'}}},
+               {'range': {'field10': {'gte': '{shipdate:lo}', 'lte': '{shipdate:hi}'}}}],
+    'must_not': [{'term': {'field8': '{returnflag}'}}],
+  }}},
+  # The pricing summary report (TPC-H Q1).
+  'terms_agg': {'size': 0, 'query': {'range': {'field10': {'lte': '{shipdate}'}}}, 'aggs': {
+    'returnflag': {'terms': {'field': 'field8'}, 'aggs': {
+      'linestatus': {'terms': {'field': 'field9'}, 'aggs': {
+        'sum_qty': {'sum': {'field': 'field4'}},
+        'sum_base_price': {'sum': {'field': 'field5'}},
+        'avg_disc': {'avg': {'field': 'field6'}},
+      }},
+    }},
+  }},
+  'date_histogram': {'size': 0, 'query': {'range': {'field10': {'gte': '{shipdate:lo}', 'lte': '{shipdate:hi}'}}},
+                     'aggs': {'per_month': {'date_histogram': {'field': 'field11', 'interval': 'month'},
+                                            'aggs': {'revenue': {'sum': {'field': 'field5'}}}}}},
+  'sort': {'size': 10, 'query': {'term': {'field14': '{shipmode}'}}, 'sort': [{'field5': 'desc'}]},
+}
+COLUMN_IDS = dict((name, i) for i, (name, _) in enumerate(lineitem.COLUMNS))
+POOL_LINES = 10000
+
+
+def parse_query_line(line):
+  # Returns the template name and body of a line of a query file: either
+  # "<template>\t<json body>" as written by this script, or the original
+  # "<field-id>|<text>" match query, which has no template name.
+  line = line.rstrip('\r\n')
+  if '\t' in line:
+    name, body = line.split('\t', 1)
+    return name, json.loads(body)
+  field_id, query = line.strip().split('|', 2)
+  return None, {'query': {'match': {'field%s' % field_id: query}}}
+
+
+class ValuePools(object):
+  # Column values of a random sample of the lines of a data file.
+  def __init__(self, data_file, rng, limit=POOL_LINES):
+    lines = []
+    with open(data_file) as ifp:
+      for i, line in enumerate(ifp):
+        if i < limit:
+          lines.append(line)
+        else:
+          j = rng.randint(0, i)
+          if j < limit:
+            lines[j] = line
+    self.columns = [[] for _ in lineitem.COLUMNS]
+    for line in lines:
+      fields = line.rstrip('\r\n').split('|')
+      for i in range(0, min(len(fields), len(self.columns))):
+        try:
+          self.columns[i].append(lineitem.converters[i](fields[i]))
+        except ValueError:
+          continue
+    self.words = [word.strip('.,;:!?') for value in self.columns[COLUMN_IDS['comment']] for word in value.split()]
+    self.words = [word for word in self.words if word]
+
+  def draw(self, column, rng):
+    if column not in COLUMN_IDS:
+      raise ValueError('Unknown column %s' % column)
+    values = self.columns[COLUMN_IDS[column]]
+    if not values:
+      raise ValueError('No values for column %s' % column)
+    return rng.choice(values)
+
+
+def placeholder(value):
+  if isinstance(value, basestring) and len(value) > 2 and value[0] == '{' and value[-1] == '}':
+    return value[1:-1]
+  return None
+
+
+def fill(template, pools, rng, drawn=None):
+  # Returns a copy of template with its placeholders replaced. Dict keys are
+  # visited in sorted order so that a seed always produces the same queries.
+  if drawn is None:
+    drawn = {}
+  if isinstance(template, dict):
+    return dict((key, fill(template[key], pools, rng, drawn)) for key in sorted(template))
+  if isinstance(template, list):
+    return [fill(value, pools, rng, drawn) for value in template]
+  name = placeholder(template)
+  if name is None:
+    return template
+  if name not in drawn:
+    column, _, part = name.partition(':')
+    if part in ('lo', 'hi'):
+      lo, hi = sorted([pools.draw(column, rng), pools.draw(column, rng)])
+      drawn[column + ':lo'] = lo
+      drawn[column + ':hi'] = hi
+    elif part == 'word':
+      if column != 'comment':
+        drawn[name] = rng.choice(str(pools.draw(column, rng)).split() or [''])
+      else:
+        drawn[name] = rng.choice(pools.words)
+    elif part == '':
+      drawn[name] = pools.draw(column, rng)
+    else:
+      raise ValueError('Invalid placeholder {%s}' % name)
+  return drawn[name]
+
+
+def parse_templates(arg, templates):
+  # "name[:weight],..." -> [(name, weight)]
+  selected = []
+  for item in arg.split(','):
+    name, _, weight = item.partition(':')
+    if name not in templates:
+      raise ValueError('Unknown template %s' % name)
+    weight = float(weight) if weight else 1.0
+    if weight <= 0:
+      raise ValueError('Template weights must be positive')
+    selected.append((name, weight))
+  return selected
+
+
+def generate(data_file, templates, selected, count, seed, pool_lines=POOL_LINES):
+  # Yields count (name, body) pairs, the templates picked at random in
+  # proportion to their weights. The same seed gives the same queries.
+  rng = random.Random(seed)
+  pools = ValuePools(data_file, rng, pool_lines)
+  total = sum(weight for _, weight in selected)
+  for _ in range(0, count):
+    pick = rng.random() * total
+    for name, weight in selected:
+      pick -= weight
+      if pick < 0:
+        break
+    yield name, fill(templates[name], pools, rng)
+
+
+def main(argv):
+  data_file = ''
+  output_file = ''
+  count = 1000
+  seed = 0
+  template_arg = ''
+  template_file = ''
+  pool_lines = POOL_LINES
+  help_msg = ('querygen.py -d <data-file> -o <output-file> -n <count> -s <seed> -t <template[:weight],...> '
+              '-f <template-file> -p <pool-lines>')
+  try:
+    opts, args = getopt.getopt(argv, 'hd:o:n:s:t:f:p:', ['data=', 'output=', 'count=', 'seed=', 'templates=',
+                                                       'template-file=', 'pool-lines='])
+  except getopt.GetoptError:
+    print help_msg
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt == '-h':
+      print help_msg
+      print 'Templates: %s' % ', '.join(sorted(TEMPLATES))
+      sys.exit()
+    elif opt in ('-d', '--data'):
+      data_file = arg
+    elif opt in ('-o', '--output'):
+      output_file = arg
+    elif opt in ('-n', '--count'):
+      count = int(arg)
+    elif opt in ('-s', '--seed'):
+      seed = int(arg)
+    elif opt in ('-t', '--templates'):
+      template_arg = arg
+    elif opt in ('-f', '--template-file'):
+      template_file = arg
+    elif opt in ('-p', '--pool-lines'):
+      pool_lines = int(arg)
+
+  if data_file == '' or output_file == '':
+    print 'Error: Must specify data file and output file!'
+    sys.exit(2)
+
+  try:
+    templates = dict(TEMPLATES)
+    if template_file != '':
+      # A JSON object of template name to query body.
+      with open(template_file) as ifp:
+        templates.update(json.load(ifp))
+    selected = parse_templates(template_arg or ','.join(sorted(templates)), templates)
+    queries = 0
+    with open(output_file, 'w') as out:
+      for name, body in generate(data_file, templates, selected, count, seed, pool_lines):
+        out.write('%s\t%s\n' % (name, json.dumps(body, sort_keys=True)))
+        queries += 1
+  except (IOError, ValueError) as e:
+    print 'Error: %s' % e
+    sys.exit(2)
+  print 'Wrote %d queries to %s' % (queries, output_file)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import glob
+import socket
+import getopt
+import platform
+import elasticsearch
+from elasticsearch import TransportError, ConnectionError
+import histogram
+
+# Every benchmark and load run writes one JSON record to the results
+# directory: the tool, a name identifying what was measured (the workload,
+# benchtype or load), an optional label such as the Elasticsearch version
+# under test, the run's configuration, the client and cluster environment,
+# and its metrics. Metrics are a flat mapping of name to value; names ending
+# in "/s" are rates, where higher is better; for all others (latencies in
+# microseconds, failure counts, durations) lower is better. Latency histograms
+# and time series are stored as well, for later analysis.
+#
+# Running this script compares runs: the candidate runs against the baseline
+# runs, pairing runs of the same tool and name. With several runs (repetitions)
+# on both sides, every metric gets a Welch's t-test, and a change is flagged as
+# a regression if it is worse by more than the threshold and significant.
+RESULTS_DIR = 'results'
+THRESHOLD = 5.0
+ALPHA = 0.05
+
+
+def latency_metrics(prefix, latencies):
+  metrics = {'%s mean (us)' % prefix: latencies.mean()}
+  for p in histogram.PERCENTILES:
+    metrics['%s p%g (us)' % (prefix, p)] = latencies.percentile(p)
+  metrics['%s max (us)' % prefix] = latencies.max
+  return metrics
+
+
+def environment(es, index):
+  # What the numbers depend on besides the configuration. Cluster details
+  # are best effort: a run is recorded even if they cannot be fetched.
+  env = {
+    'host': socket.gethostname(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'client': elasticsearch.__versionstr__,
+  }
+  try:
+    info = es.info()
+    env['cluster_name'] = info.get('cluster_name')
+    env['version'] = info.get('version', {}).get('number')
+    env['nodes'] = es.cluster.health().get('number_of_nodes')
+    settings = es.indices.get_settings(index=index).get(index, {}).get('settings', {}).get('index', {})
+    env['index'] = {'shards': settings.get('number_of_shards'), 'replicas': settings.get('number_of_replicas'),
+                    'docs': es.count(index=index)['count']}
+  except (TransportError, ConnectionError) as e:
+    env['error'] = str(e)
+  return env
+
+
+def save(results_dir, tool, name, label, config, env, metrics, extra=None):
+  # Writes the record and returns its path; does nothing if results_dir is
+  # empty.
+  if not results_dir:
+    return None
+  if not os.path.isdir(results_dir):
+    os.makedirs(results_dir)
+  now = time.time()
+  record = dict(extra or {})
+  record.update({'tool': tool, 'name': name, 'label': label, 'time': now, 'config': config, 'environment': env,
+                 'metrics': metrics})
+  path = os.path.join(results_dir, '%s-%s-%s-%d.json' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), tool,
+                                                         re.sub(r'[^A-Za-z0-9.+-]+', '_', name), os.getpid()))
+  with open(path, 'w') as out:
+    json.dump(record, out, sort_keys=True)
+  return path
+
+
+def load(spec, results_dir=RESULTS_DIR):
+  # spec is a record file, a directory of them, or a label in results_dir.
+  if os.path.isfile(spec):
+    paths = [spec]
+  elif os.path.isdir(spec):
+    paths = glob.glob(os.path.join(spec, '*.json'))
+  else:
+    paths = glob.glob(os.path.join(results_dir, '*.json'))
+  records = []
+  for path in sorted(paths):
+    with open(path) as ifp:
+      record = json.load(ifp)
+    if os.path.isfile(spec) or os.path.isdir(spec) or record.get('label') == spec:
+      records.append(record)
+  if not records:
+    raise ValueError('No results for %s' % spec)
+  return records
+
+
+def mean_variance(values):
+  mean = sum(values) / float(len(values))
+  if len(values) < 2:
+    return mean, 0.0
+  return mean, sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+
+def beta_fraction(a, b, x):
+  # Continued fraction for the incomplete beta function (Numerical Recipes).
+  tiny = 1e-30
+  c = 1.0
+  d = 1.0 - (a + b) * x / (a + 1.0)
+  d = 1.0 / (d if abs(d) > tiny else tiny)
+  h = d
+  for m in range(1, 200):
+    for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                      -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+      d = 1.0 + numerator * d
+      d = 1.0 / (d if abs(d) > tiny else tiny)
+      c = 1.0 + numerator / c
+      c = c if abs(c) > tiny else tiny
+      h *= d * c
+    if abs(d * c - 1.0) < 1e-12:
+      break
+  return h
+
+
+def incomplete_beta(a, b, x):
+  if x <= 0.0:
+    return 0.0
+  if x >= 1.0:
+    return 1.0
+  front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1.0 - x))
+  if x < (a + 1.0) / (a + b + 2.0):
+    return front * beta_fraction(a, b, x) / a
+  return 1.0 - front * beta_fraction(b, a, 1.0 - x) / b
+
+
+def welch_test(baseline, candidate):
+  # Two-sided p-value of Welch's t-test for a difference in means, or None
+  # with fewer than two runs on either side.
+  if len(baseline) < 2 or len(candidate) < 2:
+    return None
+  mean_a, var_a = mean_variance(baseline)
+  mean_b, var_b = mean_variance(candidate)
+  se_a = var_a / len(baseline)
+  se_b = var_b / len(candidate)
+  if se_a + se_b == 0.0:
+    return 1.0 if mean_a == mean_b else 0.0
+  t = (mean_b - mean_a) / math.sqrt(se_a + se_b)
+  df = (se_a + se_b) ** 2 / (se_a ** 2 / (len(baseline) - 1) + se_b ** 2 / (len(candidate) - 1))
+  return incomplete_beta(df / 2.0, 0.5, df / (df + t * t))
+
+
+def compare_metric(name, baseline, candidate, threshold, alpha):
+  # Returns (baseline mean, candidate mean, change in percent, p-value,
+  # verdict), where the verdict is 'REGRESSION', 'improvement' or ''. Without
+  # a p-value (fewer than two runs a side) changes beyond the threshold are
+  # only marked 'worse (untested)' or 'better (untested)'.
+  mean_a = mean_variance(baseline)[0]
+  mean_b = mean_variance(candidate)[0]
+  change = (mean_b - mean_a) / mean_a * 100.0 if mean_a else 0.0
+  p = welch_test(baseline, candidate)
+  worse = -change if name.endswith('/s') else change
+  verdict = ''
+  if abs(change) > threshold:
+    if p is None:
+      verdict = 'worse (untested)' if worse > 0 else 'better (untested)'
+    elif p < alpha:
+      verdict = 'REGRESSION' if worse > 0 else 'improvement'
+  return mean_a, mean_b, change, p, verdict
+
+
+def config_differences(baseline, candidate):
+  keys = set()
+  for a in baseline:
+    for b in candidate:
+      keys.update(key for key in set(a['config']) | set(b['config']) if a['config'].get(key) != b['config'].get(key))
+  return sorted(keys)
+
+
+def compare(baseline, candidate, threshold=THRESHOLD, alpha=ALPHA, out=sys.stdout):
+  # Prints a table per (tool, name) found on both sides and returns the
+  # number of regressions.
+  groups = {}
+  for side, records in ((0, baseline), (1, candidate)):
+    for record in records:
+      groups.setdefault((record['tool'], record['name']), ([], []))[side].append(record)
+  regressions = 0
+  for (tool, name), (base, cand) in sorted(groups.items()):
+    if not base or not cand:
+      print >> out, '%s %s: only in %s, skipped' % (tool, name, 'candidate' if cand else 'baseline')
+      continue
+    print >> out, '%s %s: %d baseline vs %d candidate runs' % (tool, name, len(base), len(cand))
+    differences = config_differences(base, cand)
+    if differences:
+      print >> out, '  Warning: configurations differ in %s' % ', '.join(differences)
+    if len(base) < 2 or len(cand) < 2:
+      print >> out, ('  Note: fewer than 2 runs on a side, changes are not tested for significance or counted '
+                     'as regressions')
+    print >> out, '  %-40s %14s %14s %9s %8s' % ('metric', 'baseline', 'candidate', 'change', 'p')
+    metrics = set(base[0]['metrics'])
+    for record in base + cand:
+      metrics &= set(record['metrics'])
+    for metric in sorted(metrics):
+      a = [float(record['metrics'][metric]) for record in base]
+      b = [float(record['metrics'][metric]) for record in cand]
+      mean_a, mean_b, change, p, verdict = compare_metric(metric, a, b, threshold, alpha)
+      if verdict == 'REGRESSION':
+        regressions += 1
+      print >> out, '  %-40s %14.2f %14.2f %+8.1f%% %8s %s' % (metric, mean_a, mean_b, change,
+                                                              '%.3f' % p if p is not None else '-', verdict)
+  return regressions
+
+
+def main(argv):
+  results_dir = RESULTS_DIR
+  baseline_spec = ''
+  candidate_spec = ''
+  threshold = THRESHOLD
+  alpha = ALPHA
+  list_runs = False
+  help_msg = ('results.py -b <baseline> -c <candidate> -O <results-dir> -t <threshold-pct> -a <alpha> -l\n'
+              '  baseline and candidate are a result file, a directory of them, or a label')
+  try:
+    opts, args = getopt.getopt(argv, 'hb:c:O:t:a:l', ['baseline=', 'candidate=', 'results-dir=', 'threshold=',
+                                                     'alpha=', 'list'])
+  except getopt.GetoptError:
+    print help_msg
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt == '-h':
+      print help_msg
+      sys.exit()
+    elif opt in ('-b', '--baseline'):
+      baseline_spec = arg
+    elif opt in ('-c', '--candidate'):
+      candidate_spec = arg
+    elif opt in ('-O', '--results-dir'):
+      results_dir = arg
+    elif opt in ('-t', '--threshold'):
+      threshold = float(arg)
+    elif opt in ('-a', '--alpha'):
+      alpha = float(arg)
+    elif opt in ('-l', '--list'):
+      list_runs = True
+
+  try:
+    if list_runs:
+      for record in load(results_dir, results_dir):
+        print '%s\t%s\t%s\t%s\t%s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time'])),
+                                      record['tool'], record['name'], record.get('label') or '-',
+                                      record['environment'].get('version') or '-')
+      return
+    if baseline_spec == '' or candidate_spec == '':
+      print 'Error: Must specify baseline and candidate runs!'
+      sys.exit(2)
+    regressions = compare(load(baseline_spec, results_dir), load(candidate_spec, results_dir), threshold, alpha)
+  except (IOError, ValueError) as e:
+    print 'Error: %s' % e
+    sys.exit(2)
+  if regressions:
+    print '%d regressions' % regressions
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,156 @@
+import sys
+import time
+import threading
+import clock
+
+# A concurrency sweep runs the benchmark at a series of thread counts in one
+# go. All threads are created up front, each with its own connections, and
+# live for the whole sweep; a step runs the first `active` of them while the
+# rest wait. Threads that stay active keep sending requests across step
+# boundaries, so connections and server-side caches stay warm and only one
+# warmup is needed. Every step starts with a short settle period that is not
+# measured, then is measured until throughput is stable or the measure time
+# is up.
+STABLE_WINDOW = 5
+STABILITY = 5.0
+MIN_STEP = 10.0
+
+# The knee is the last step before the first one that gains less than
+# KNEE_GAIN percent throughput over the previous step while its latency
+# percentile grows by more than KNEE_LATENCY percent. The sweep stops after
+# KNEE_STOP consecutive steps without a throughput gain.
+KNEE_GAIN = 5.0
+KNEE_LATENCY = 20.0
+KNEE_STOP = 2
+
+
+def parse_levels(arg):
+  # "1,2,8,32" or "lo:hi", which doubles from lo up to hi.
+  if ':' in arg:
+    lo, hi = [int(value) for value in arg.split(':')]
+    if lo < 1 or hi < lo:
+      raise ValueError('Invalid concurrency range %s' % arg)
+    levels = []
+    level = lo
+    while level < hi:
+      levels.append(level)
+      level *= 2
+    return levels + [hi]
+  levels = [int(value) for value in arg.split(',')]
+  if not levels or min(levels) < 1:
+    raise ValueError('Concurrency levels must be positive')
+  return levels
+
+
+def stable(rates, tolerance, window=STABLE_WINDOW):
+  # True if the last window per-interval rates vary by at most tolerance
+  # percent (coefficient of variation).
+  if len(rates) < window:
+    return False
+  rates = rates[-window:]
+  mean = sum(rates) / len(rates)
+  if mean <= 0:
+    return False
+  variance = sum((rate - mean) ** 2 for rate in rates) / (len(rates) - 1)
+  return variance ** 0.5 / mean * 100.0 <= tolerance
+
+
+def gain(previous, current):
+  return (current - previous) / float(previous) * 100.0 if previous > 0 else float('inf')
+
+
+def find_knee(steps, gain_threshold=KNEE_GAIN, latency_threshold=KNEE_LATENCY):
+  # steps are (concurrency, throughput, latency) tuples in sweep order.
+  # Returns the index of the knee step, or None.
+  for i in range(1, len(steps)):
+    if (gain(steps[i - 1][1], steps[i][1]) < gain_threshold and
+            gain(steps[i - 1][2], steps[i][2]) > latency_threshold):
+      return i - 1
+  return None
+
+
+class Sweep(object):
+  # Shared by the controller and the sweep threads. Every change of active
+  # thread count or measuring state starts a new generation; threads that
+  # were measuring hand in their results for the generation that ended.
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.generation = 0
+    self.active = 0
+    self.measure = False
+    self.start = clock.now()
+    self.done = False
+    self.entered = {}
+    self.handed_in = {}
+    # The first exception raised in a sweep thread, as sys.exc_info().
+    self.error = None
+
+  def begin(self, active, measure):
+    with self.condition:
+      self.generation += 1
+      self.active = active
+      self.measure = measure
+      self.start = clock.now()
+      self.condition.notify_all()
+      return self.generation
+
+  def finish(self):
+    with self.condition:
+      self.generation += 1
+      self.done = True
+      self.condition.notify_all()
+
+  def wait(self, thread_id, last):
+    # Blocks until a generation after last that runs this thread starts.
+    # Returns it and whether it is measured, or (None, False) when done.
+    with self.condition:
+      while not self.done and (self.generation == last or thread_id >= self.active):
+        last = self.generation
+        self.condition.wait(1.0)
+      if self.done:
+        return None, False
+      if self.measure:
+        self.entered[self.generation] = self.entered.get(self.generation, 0) + 1
+      return self.generation, self.measure
+
+  def fail(self):
+    # Called by a thread from its exception handler; the controller stops the
+    # sweep and re-raises the error.
+    with self.condition:
+      if self.error is None:
+        self.error = sys.exc_info()
+      self.condition.notify_all()
+
+  def hand_in(self, generation, result):
+    with self.condition:
+      self.handed_in.setdefault(generation, []).append(result)
+      self.condition.notify_all()
+
+  def collect(self, generation):
+    # The results of the threads that measured generation, once it has ended.
+    # A thread still busy with a request from before it started never entered
+    # it, so is not waited for.
+    with self.condition:
+      while len(self.handed_in.get(generation, [])) < self.entered.get(generation, 0):
+        self.condition.wait(1.0)
+      self.entered.pop(generation, None)
+      return self.handed_in.pop(generation, [])
+
+  def measure_step(self, threads, max_time, interval, tolerance, min_time=MIN_STEP):
+    # Samples the request count of the threads every interval seconds and
+    # returns the measured duration and whether throughput was stable.
+    start = self.start
+    last_count = sum(thread.completed for thread in threads)
+    last_time = clock.now()
+    rates = []
+    while last_time - start < max_time:
+      time.sleep(max(0.0, min(interval, start + max_time - last_time)))
+      count = sum(thread.completed for thread in threads)
+      now = clock.now()
+      rates.append((count - last_count) / (now - last_time))
+      last_count, last_time = count, now
+      if now - start >= min_time and stable(rates, tolerance):
+        return now - start, True
+      if self.error is not None:
+        break
+    return last_time - start, False
@@ -0,0 +1,125 @@
+import json
+import time
+import threading
+import unittest
+import BaseHTTPServer
+from elasticsearch import Elasticsearch
+import nodestats
+
+
+def node(gc_count, rejected, queue, segments):
+  return {
+    'jvm': {'gc': {'collectors': {'young': {'collection_count': gc_count, 'collection_time_in_millis': gc_count * 10}}},
+            'mem': {'heap_used_in_bytes': 1000 + gc_count}},
+    'thread_pool': {'search': {'rejected': rejected, 'queue': queue, 'completed': 100 * gc_count}},
+    'indices': {'segments': {'count': segments}, 'query_cache': {'evictions': rejected}},
+  }
+
+
+# Canned _nodes/stats responses of a two-node cluster, served in order; the
+# last one is repeated once they run out.
+RESPONSES = [
+  {'nodes': {'a': node(1, 0, 0, 5), 'b': node(2, 0, 1, 5)}},
+  {'nodes': {'a': node(3, 2, 7, 6), 'b': node(4, 1, 2, 5)}},
+  {'nodes': {'a': node(6, 4, 1, 4), 'b': node(5, 1, 0, 4)}},
+]
+
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    server = self.server
+    if not self.path.startswith('/_nodes/stats'):
+      self.send_error(404)
+      return
+    body = json.dumps(RESPONSES[min(server.requests, len(RESPONSES) - 1)])
+    server.requests += 1
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class NodeStatsTest(unittest.TestCase):
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StatsHandler)
+    self.server.requests = 0
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.es = Elasticsearch(hosts=['http://127.0.0.1:%d' % self.server.server_address[1]])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def sample_at(self, sampler, times):
+    # Takes one sample per time, replacing its timestamp.
+    for sample_time in times:
+      sampler.sample()
+      sampler.samples[-1] = (sample_time, sampler.samples[-1][1])
+
+  def test_sample_sums_nodes(self):
+    sampler = nodestats.NodeStatsSampler(self.es)
+    sampler.sample()
+    values = sampler.samples[0][1]
+    self.assertEqual(values['jvm.gc.collectors.young.collection_count'], 3)
+    self.assertEqual(values['thread_pool.search.queue'], 1)
+    self.assertEqual(values['indices.segments.count'], 10)
+    self.assertEqual(sampler.errors, 0)
+
+  def test_phase_stats(self):
+    sampler = nodestats.NodeStatsSampler(self.es, phases=[('warmup', 0.0, 10.0), ('measure', 10.0, 20.0)],
+                                         start_time=100.0)
+    self.sample_at(sampler, [100.0, 110.0, 120.0])
+    results = sampler.results()
+    self.assertEqual(sorted(results), ['measure', 'warmup'])
+
+    # Counters are the increase between the samples at the phase boundaries.
+    warmup = results['warmup']
+    self.assertEqual((warmup['start'], warmup['end']), (0.0, 10.0))
+    self.assertEqual(warmup['counters']['jvm.gc.collectors.young.collection_count'], 4)
+    self.assertEqual(warmup['counters']['thread_pool.search.rejected'], 3)
+    measure = results['measure']
+    self.assertEqual((measure['start'], measure['end']), (10.0, 20.0))
+    self.assertEqual(measure['counters']['jvm.gc.collectors.young.collection_count'], 4)
+    self.assertEqual(measure['counters']['thread_pool.search.rejected'], 2)
+    self.assertEqual(measure['counters']['indices.query_cache.evictions'], 2)
+
+    # Gauges are the maximum over the samples of the phase.
+    self.assertEqual(warmup['gauges']['thread_pool.search.queue'], 9)
+    self.assertEqual(measure['gauges']['thread_pool.search.queue'], 9)
+    self.assertEqual(warmup['gauges']['indices.segments.count'], 11)
+    self.assertEqual(measure['gauges']['indices.segments.count'], 11)
+    self.assertNotIn('thread_pool.search.queue', measure['counters'])
+
+  def test_phase_assignment_by_timestamp(self):
+    # Samples are assigned to a phase by time: the first sample at or after
+    # its start and the first at or after its end bound it.
+    sampler = nodestats.NodeStatsSampler(self.es, phases=[('warmup', 0.0, 5.0), ('measure', 5.0, 20.0),
+                                                          ('cooldown', 20.0, 30.0)], start_time=0.0)
+    self.sample_at(sampler, [0.0, 4.0, 12.0])
+    results = sampler.results()
+    self.assertEqual((results['warmup']['start'], results['warmup']['end']), (0.0, 12.0))
+    self.assertEqual(results['warmup']['counters']['thread_pool.search.rejected'], 5)
+    # The measure phase has no sample at its end, so it runs to the last one.
+    self.assertEqual((results['measure']['start'], results['measure']['end']), (12.0, 12.0))
+    self.assertEqual(results['measure']['counters']['thread_pool.search.rejected'], 0)
+    self.assertEqual(results['measure']['gauges']['thread_pool.search.queue'], 1)
+    # No sample falls in the cooldown phase.
+    self.assertNotIn('cooldown', results)
+
+  def test_sampler_thread(self):
+    sampler = nodestats.NodeStatsSampler(self.es, interval=0.05, phases=[('run', 0.0, 0.1)])
+    sampler.start()
+    time.sleep(0.2)
+    sampler.stop()
+    self.assertGreaterEqual(len(sampler.samples), 3)
+    self.assertIn('run', sampler.results())
+
+
+if __name__ == '__main__':
+  unittest.main()
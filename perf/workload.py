@@ -0,0 +1,561 @@
+import os
+import re
+import sys
+import json
+import random
+import threading
+from array import array
+from elasticsearch import TransportError
+from elasticsearch.client.utils import _make_path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'load'))
+import lineitem
+import keys
+import querygen
+import cache as result_cache
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
+# A workload is a list of operations, each with a relative weight:
+#
+#   {
+#     "operations": [
+#       {"type": "get", "weight": 70},
+#       {"type": "search", "weight": 25, "queries": "perf/sample/queries", "size": 100},
+#       {"type": "index", "weight": 5, "appends": "load/sample/table.dat"}
+#     ]
+#   }
+#
+# Every operation may override "index" and "doc_type" and set a "name" to
+# report it under (defaults to its type). Searches take "size" (default 10000)
+# and "fields" (default []). Gets take a key "distribution" (see keys.py,
+# default uniform) with its "exponent" (zipfian and latest, default 0.99) or
+# "hot_requests" and "hot_keys" fractions (hotspot, default 0.8 and 0.2).
+# Searches may also set a "filter_path" for the server to trim responses with.
+# A query file written by querygen.py may hold several templates; a search
+# over it reports the latency of each under "<name>:<template>", and the
+# template's own "size" takes precedence over the operation's.
+# With "raw" set, an operation sends its pre-serialized body straight to a
+# connection and counts hits in the undecoded response body instead of
+# having the client decode the JSON.
+#
+# An "mget" operation looks up "batch_size" ids (default 10) per request and
+# takes the same key parameters as a get. A get with "coalesce" set to a
+# window in seconds does not send its own request: the gets that threads issue
+# within the window are gathered into one mget of at most "batch_size" ids.
+#
+# A "bulk" operation indexes "batch_size" documents (default 1000) from its
+# "appends" file per _bulk request, with ids chosen by Elasticsearch. Items
+# the cluster rejects (status 429) or fails are counted, not retried.
+#
+# A top-level "cache" setting (see cache.py) puts a client-side result cache
+# in front of the gets and searches; an operation can opt out with
+# "cache": false. Appends invalidate the cached searches of their index.
+OPERATION_TYPES = ('get', 'mget', 'search', 'index', 'bulk')
+MAX_OPERANDS = 100000
+
+# The fixed benchmark types, expressed as workloads.
+BENCH_TYPES = {
+  'get': [('get', 1)],
+  'search': [('search', 1)],
+  'search-append': [('search', 19), ('index', 1)],
+  'get-append': [('get', 19), ('index', 1)],
+  'get-search': [('get', 1), ('search', 1)],
+  'mget': [('mget', 1)],
+  'bulk': [('bulk', 1)],
+  'bulk-search': [('search', 1), ('bulk', 1)],
+}
+BULK_COUNTERS = ('docs', 'bytes', 'rejected', 'failed')
+BULK_ERRORS = re.compile(r'"errors"\s*:\s*true')
+BULK_REJECTED = re.compile(r'"status"\s*:\s*429\b')
+BULK_FAILED = re.compile(r'"error"\s*:')
+
+
+def bench_type_workload(bench_type, query_file, append_file, key_params=None):
+  if bench_type not in BENCH_TYPES:
+    raise ValueError('Invalid benchtype %s' % bench_type)
+  operations = []
+  for op_type, weight in BENCH_TYPES[bench_type]:
+    operation = {'type': op_type, 'weight': weight}
+    if op_type in ('get', 'mget') and key_params:
+      operation.update(key_params)
+    elif op_type == 'search':
+      operation['queries'] = query_file
+    elif op_type in ('index', 'bulk'):
+      operation['appends'] = append_file
+    operations.append(operation)
+  return {'name': bench_type.replace('-', '+'), 'operations': operations}
+
+
+def read_workload(path):
+  with open(path) as ifp:
+    if path.endswith('.yaml') or path.endswith('.yml'):
+      if yaml is None:
+        raise ValueError('PyYAML is required for YAML workloads (pip install pyyaml)')
+      spec = yaml.safe_load(ifp)
+    else:
+      spec = json.load(ifp)
+  if not isinstance(spec, dict):
+    raise ValueError('Workload %s must be a mapping' % path)
+  spec.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+  return spec
+
+
+def validate(workload):
+  operations = workload.get('operations')
+  if not operations:
+    raise ValueError('Workload has no operations')
+  if workload.get('cache') and workload['cache'].get('type', 'lru') not in result_cache.CACHE_TYPES:
+    raise ValueError('Invalid cache type %s' % workload['cache']['type'])
+  for operation in operations:
+    op_type = operation.get('type')
+    if op_type not in OPERATION_TYPES:
+      raise ValueError('Invalid operation type %s' % op_type)
+    if op_type == 'search' and not operation.get('queries'):
+      raise ValueError('Must specify query-file for search benchmark!')
+    if op_type in ('index', 'bulk') and not operation.get('appends'):
+      raise ValueError('Must specify append-file for append benchmark!')
+    if op_type in ('get', 'mget') and operation.get('distribution', 'uniform') not in keys.DISTRIBUTIONS:
+      raise ValueError('Invalid key distribution %s' % operation['distribution'])
+    if operation.get('weight', 1) <= 0:
+      raise ValueError('Operation weights must be positive')
+    if operation.get('batch_size', 10) < 1:
+      raise ValueError('Batch size must be positive')
+  return workload
+
+
+def csv2json(csv, typed=False):
+  fields = csv.split('|')
+  if typed:
+    return lineitem.typed_fields(fields)
+  json = {}
+  for i in range(0, len(fields)):
+    json['field%d' % i] = fields[i]
+  return json
+
+
+def sample_lines(path, limit):
+  # Reservoir sample of at most limit lines, in random order, so only the
+  # sampled lines are ever held in memory.
+  lines = []
+  with open(path) as ifp:
+    for i, line in enumerate(ifp):
+      if i < limit:
+        lines.append(line)
+      else:
+        j = random.randint(0, i)
+        if j < limit:
+          lines[j] = line
+  random.shuffle(lines)
+  return lines
+
+
+class KeyCorpus(object):
+  # Document ids, packed into an array of machine integers.
+  def __init__(self, keys):
+    self.keys = array('l', keys)
+
+  def __len__(self):
+    return len(self.keys)
+
+  def __getitem__(self, i):
+    return self.keys[i]
+
+
+class BodyCorpus(object):
+  # JSON request bodies, serialized once and concatenated into one string.
+  # Item i is the slice between offsets i and i + 1. Items may be labelled,
+  # e.g. with the template a query was made from: label_ids[i] indexes into
+  # labels.
+  def __init__(self, bodies, labels=None):
+    self.offsets = array('l', [0])
+    for body in bodies:
+      self.offsets.append(self.offsets[-1] + len(body))
+    self.buffer = ''.join(bodies)
+    self.labels = None
+    self.label_ids = None
+    if labels is not None:
+      self.labels = sorted(set(labels))
+      ids = dict((label, i) for i, label in enumerate(self.labels))
+      self.label_ids = array('H', [ids[label] for label in labels])
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    return self.buffer[self.offsets[i]:self.offsets[i + 1]]
+
+
+def load_search_queries(query_file, size=10000, fields=None):
+  # Result size and fields go into the bodies, where a template's own size
+  # overrides them.
+  queries = []
+  templates = []
+  for line in sample_lines(query_file, MAX_OPERANDS):
+    template, body = querygen.parse_query_line(line)
+    body.setdefault('size', size)
+    body.setdefault('fields', fields if fields is not None else [])
+    queries.append(json.dumps(body))
+    templates.append(template or '')
+  if not any(templates):
+    return BodyCorpus(queries)
+  return BodyCorpus(queries, templates)
+
+
+def load_appends(append_file, typed):
+  return BodyCorpus([json.dumps(csv2json(line.rstrip(), typed)) for line in sample_lines(append_file, MAX_OPERANDS)])
+
+
+def load_corpora(workload, record_count, typed=False):
+  # Returns the corpus (ids, query bodies or documents) each operation cycles
+  # through, in the order of workload['operations']. Corpora are read-only and
+  # shared by all the threads of a process.
+  corpora = []
+  for operation in workload['operations']:
+    if operation['type'] in ('get', 'mget'):
+      corpora.append(KeyCorpus(keys.sample_keys(operation.get('distribution', 'uniform'),
+                                                min(MAX_OPERANDS, record_count), record_count,
+                                                operation.get('exponent', 0.99), operation.get('hot_requests', 0.8),
+                                                operation.get('hot_keys', 0.2))))
+    elif operation['type'] == 'search':
+      corpora.append(load_search_queries(operation['queries'], operation.get('size', 10000),
+                                         operation.get('fields', [])))
+    else:
+      corpora.append(load_appends(operation['appends'], typed))
+    if len(corpora[-1]) == 0:
+      raise ValueError('No operands for %s operation' % operation.get('name', operation['type']))
+  return corpora
+
+
+def schedule(weights):
+  # Smooth weighted round-robin: over one cycle every operation runs in
+  # proportion to its weight, spread out as evenly as possible, so the hot
+  # loop only has to index into the returned list.
+  if any(weight != int(weight) for weight in weights):
+    weights = [int(round(weight * 1000)) for weight in weights]
+  weights = [int(weight) for weight in weights]
+  divisor = reduce(keys.gcd, weights)
+  weights = [weight / divisor for weight in weights]
+  total = sum(weights)
+  current = [0] * len(weights)
+  order = []
+  for _ in range(0, total):
+    for i in range(0, len(weights)):
+      current[i] += weights[i]
+    best = current.index(max(current))
+    current[best] -= total
+    order.append(best)
+  return order
+
+
+class Operation(object):
+  # Each thread walks the shared corpus from its own starting point with its
+  # own stride (coprime with the corpus size, so every item is visited once
+  # per pass) instead of keeping a shuffled copy.
+  def __init__(self, spec, es, index, doc_type, corpus, start=0, stride=1, cache=None):
+    self.name = spec.get('name', spec['type'])
+    self.es = es
+    self.index = spec.get('index', index)
+    self.doc_type = spec.get('doc_type', doc_type)
+    self.corpus = corpus
+    self.raw = spec.get('raw', False)
+    self.cache = cache if spec.get('cache', True) else None
+    # Cached responses are stored as the raw bodies, so they are fetched
+    # from the connection like in raw mode.
+    self.connection = es.transport.get_connection() if self.raw or self.cache is not None else None
+    self.path = _make_path(self.index, self.doc_type)
+    self.operand_count = len(corpus)
+    self.cursor = start % self.operand_count
+    self.stride = stride % self.operand_count or 1
+
+  def next_operand(self):
+    operand = self.corpus[self.cursor]
+    self.cursor = (self.cursor + self.stride) % self.operand_count
+    return operand
+
+
+class GetOperation(Operation):
+  def __init__(self, spec, es, index, doc_type, corpus, start, stride, record_count, coalescer=None, cache=None):
+    Operation.__init__(self, spec, es, index, doc_type, corpus, start, stride, cache)
+    self.latest = spec.get('distribution') == 'latest'
+    self.appender = None
+    self.record_count = record_count
+    self.coalescer = coalescer
+
+  def next_key(self):
+    key = self.next_operand()
+    if self.latest:
+      # Operands are distances back from the newest document, including
+      # the ones this thread has appended so far.
+      newest = self.appender.last_id if self.appender is not None else self.record_count - 1
+      key = newest - key
+    return key
+
+  def run(self):
+    key = self.next_key()
+    if self.coalescer is not None:
+      self.coalescer.get(self.es, key)
+      return
+    if self.cache is not None:
+      cache_key = ('get', self.index, self.doc_type, key)
+      if self.cache.get(cache_key) is None:
+        _, _, data = self.connection.perform_request('GET', '%s/%d' % (self.path, key))
+        self.cache.put(cache_key, data)
+        if not self.raw:
+          json.loads(data)
+      return
+    if self.raw:
+      self.connection.perform_request('GET', '%s/%d' % (self.path, key))
+      return
+    self.es.get(index=self.index, doc_type=self.doc_type, id=key)
+
+
+class MgetOperation(GetOperation):
+  def __init__(self, spec, es, index, doc_type, corpus, start, stride, record_count):
+    GetOperation.__init__(self, spec, es, index, doc_type, corpus, start, stride, record_count)
+    self.batch_size = spec.get('batch_size', 10)
+    self.mget_path = _make_path(self.index, self.doc_type, '_mget')
+
+  def run(self):
+    ids = [self.next_key() for _ in range(self.batch_size)]
+    if self.raw:
+      self.connection.perform_request('POST', self.mget_path, body=json.dumps({'ids': ids}))
+      return
+    self.es.mget(index=self.index, doc_type=self.doc_type, body={'ids': ids})
+
+
+class CoalescedBatch(object):
+  def __init__(self):
+    self.ids = []
+    self.full = threading.Event()
+    self.done = threading.Event()
+    self.error = None
+
+
+class Coalescer(object):
+  # Shared by the threads of a process. The first get to arrive leads a new
+  # batch: it waits for the window to pass (or the batch to fill up), sends
+  # the mget for every id gathered meanwhile, and wakes up the other gets.
+  def __init__(self, index, doc_type, window, batch_size):
+    self.index = index
+    self.doc_type = doc_type
+    self.window = window
+    self.batch_size = batch_size
+    self.lock = threading.Lock()
+    self.pending = None
+
+  def get(self, es, key):
+    with self.lock:
+      batch = self.pending
+      leader = batch is None
+      if leader:
+        batch = self.pending = CoalescedBatch()
+      batch.ids.append(key)
+      if len(batch.ids) >= self.batch_size:
+        self.pending = None
+        batch.full.set()
+    if not leader:
+      batch.done.wait()
+    else:
+      batch.full.wait(self.window)
+      with self.lock:
+        if self.pending is batch:
+          self.pending = None
+      try:
+        es.mget(index=self.index, doc_type=self.doc_type, body={'ids': batch.ids})
+      except Exception as e:
+        batch.error = e
+      batch.done.set()
+    if batch.error is not None:
+      raise batch.error
+
+
+def create_cache(workload):
+  return result_cache.create_cache(workload.get('cache'))
+
+
+def create_coalescers(workload, index, doc_type):
+  # One coalescer per coalescing get operation (None for the others), to be
+  # shared by all the threads of a process.
+  coalescers = []
+  for spec in workload['operations']:
+    if spec['type'] == 'get' and spec.get('coalesce'):
+      coalescers.append(Coalescer(spec.get('index', index), spec.get('doc_type', doc_type), spec['coalesce'],
+                                  spec.get('batch_size', 10)))
+    else:
+      coalescers.append(None)
+  return coalescers
+
+
+class SearchOperation(Operation):
+  def __init__(self, spec, es, index, doc_type, corpus, start, stride, cache=None):
+    Operation.__init__(self, spec, es, index, doc_type, corpus, start, stride, cache)
+    self.filter_path = spec.get('filter_path')
+    self.params = {}
+    if self.filter_path is not None:
+      self.params['filter_path'] = self.filter_path
+    self.search_path = _make_path(self.index, '_search')
+    # Per-template names to report each query under, if the corpus has them.
+    self.names = None
+    if corpus.labels is not None:
+      base = self.name
+      self.names = ['%s:%s' % (base, label) if label else base for label in corpus.labels]
+
+  def run(self):
+    if self.names is not None:
+      self.name = self.names[self.corpus.label_ids[self.cursor]]
+    if self.cache is not None:
+      body = self.next_operand()
+      cache_key = ('search', self.index, body)
+      data = self.cache.get(cache_key)
+      if data is None:
+        _, _, data = self.connection.perform_request('POST', self.search_path, self.params, body)
+        self.cache.put(cache_key, data, self.index)
+        if not self.raw:
+          return len(json.loads(data).get('hits', {}).get('hits', []))
+      return data.count('"_id":')
+    if self.raw:
+      # Every hit carries its _id, so counting those counts the hits.
+      _, _, data = self.connection.perform_request('POST', self.search_path, self.params, self.next_operand())
+      return data.count('"_id":')
+    count = 0
+    if self.filter_path is not None:
+      res = self.es.search(index=self.index, body=self.next_operand(), filter_path=self.filter_path)
+    else:
+      res = self.es.search(index=self.index, body=self.next_operand())
+    for _ in res.get('hits', {}).get('hits', []):
+      count += 1
+    return count
+
+
+class IndexOperation(Operation):
+  def __init__(self, spec, es, index, doc_type, corpus, start, stride, next_id, cache=None):
+    Operation.__init__(self, spec, es, index, doc_type, corpus, start, stride)
+    self.next_id = next_id
+    self.last_id = next_id - 1
+    # Appends invalidate the cache even when they do not go through it.
+    self.invalidates = cache
+
+  def run(self):
+    if self.raw:
+      self.connection.perform_request('PUT', '%s/%d' % (self.path, self.next_id), body=self.next_operand())
+    else:
+      self.es.index(index=self.index, doc_type=self.doc_type, id=str(self.next_id), body=self.next_operand())
+    if self.invalidates is not None:
+      self.invalidates.invalidate(self.index, ('get', self.index, self.doc_type, self.next_id))
+    self.last_id = self.next_id
+    self.next_id += 1
+
+
+class BulkOperation(Operation):
+  def __init__(self, spec, es, index, doc_type, corpus, start, stride, cache=None):
+    Operation.__init__(self, spec, es, index, doc_type, corpus, start, stride)
+    self.batch_size = spec.get('batch_size', 1000)
+    self.action = json.dumps({'index': {}}) + '\n'
+    self.bulk_path = _make_path(self.index, self.doc_type, '_bulk')
+    self.invalidates = cache
+    self.reset()
+
+  def reset(self):
+    # Item counts since the last reset: documents indexed, request bytes
+    # sent, and items rejected or failed.
+    self.counters = dict.fromkeys(BULK_COUNTERS, 0)
+
+  def run(self):
+    lines = []
+    for _ in range(self.batch_size):
+      lines.append(self.action)
+      lines.append(self.next_operand())
+      lines.append('\n')
+    body = ''.join(lines)
+    self.counters['bytes'] += len(body)
+    try:
+      if self.raw:
+        _, _, data = self.connection.perform_request('POST', self.bulk_path, body=body)
+        rejected = failed = 0
+        if BULK_ERRORS.search(data):
+          rejected = len(BULK_REJECTED.findall(data))
+          failed = len(BULK_FAILED.findall(data)) - rejected
+      else:
+        res = self.es.bulk(index=self.index, doc_type=self.doc_type, body=body)
+        rejected = failed = 0
+        if res.get('errors'):
+          for item in res['items']:
+            status = item.values()[0].get('status', 200)
+            if status == 429:
+              rejected += 1
+            elif status >= 300:
+              failed += 1
+    except TransportError as e:
+      # The whole request was turned away, e.g. by a full bulk queue.
+      if e.status_code != 429:
+        raise
+      rejected, failed = self.batch_size, 0
+    self.counters['docs'] += self.batch_size - rejected - failed
+    self.counters['rejected'] += rejected
+    self.counters['failed'] += failed
+    if self.invalidates is not None:
+      self.invalidates.invalidate(self.index)
+
+
+def reset_counters(operations):
+  for operation in operations:
+    if isinstance(operation, BulkOperation):
+      operation.reset()
+
+
+def operation_counters(operations):
+  # The bulk counters of every operation name, summed over operations that
+  # share one.
+  counters = {}
+  for operation in operations:
+    if isinstance(operation, BulkOperation):
+      merge_counters(counters, {operation.name: operation.counters})
+  return counters
+
+
+def merge_counters(merged, counters):
+  for name, values in counters.items():
+    totals = merged.setdefault(name, dict.fromkeys(BULK_COUNTERS, 0))
+    for counter, value in values.items():
+      totals[counter] += value
+  return merged
+
+
+def thread_stride(count, thread_id):
+  if thread_id == 0 or count < 2:
+    return 1
+  stride = random.randrange(1, count)
+  while keys.gcd(stride, count) != 1:
+    stride += 1
+  return stride
+
+
+def create_operations(workload, corpora, es, index, doc_type, record_count, thread_id=0, num_threads=1,
+                      coalescers=None, cache=None):
+  if coalescers is None:
+    coalescers = [None] * len(corpora)
+  operations = []
+  for spec, corpus, coalescer in zip(workload['operations'], corpora, coalescers):
+    start = len(corpus) * thread_id // num_threads
+    stride = thread_stride(len(corpus), thread_id)
+    if spec['type'] == 'get':
+      operations.append(GetOperation(spec, es, index, doc_type, corpus, start, stride, record_count, coalescer,
+                                     cache))
+    elif spec['type'] == 'mget':
+      operations.append(MgetOperation(spec, es, index, doc_type, corpus, start, stride, record_count))
+    elif spec['type'] == 'search':
+      operations.append(SearchOperation(spec, es, index, doc_type, corpus, start, stride, cache))
+    elif spec['type'] == 'bulk':
+      operations.append(BulkOperation(spec, es, index, doc_type, corpus, start, stride, cache))
+    else:
+      operations.append(IndexOperation(spec, es, index, doc_type, corpus, start, stride, record_count, cache))
+  appenders = dict((operation.index, operation) for operation in reversed(operations)
+                   if isinstance(operation, IndexOperation))
+  for operation in operations:
+    if isinstance(operation, GetOperation):
+      operation.appender = appenders.get(operation.index)
+  return operations